@@ -1,25 +1,78 @@
 from __future__ import annotations
 
+import asyncio
+import functools
 import tomllib
 from typing import TYPE_CHECKING
 
-from aiohttp import web
-from aiohttp.web import Response
+from aiohttp import WSMsgType, web
+from aiohttp.web import Response, StreamResponse
 
+from utils.audio import (
+  BATCH_MAX_BYTES,
+  BATCH_MAX_FILES,
+  DETECT_MAX_BYTES,
+  PCM_FORMATS,
+  BatchTooLargeError,
+  Upload,
+  UploadTooLargeError,
+  read_pcm,
+  unpack_archive,
+)
 from utils.cors import add_cors_routes
+from utils.formats import FORMATS, dumps, render, render_batch, segment_packet
+from utils.jobs import MAX_BYTES as JOB_MAX_BYTES, job_queue
 from utils.limiter import Limiter
-from utils.whisper import transcribe_file, transcribe_bytes
+from utils.limiter_stores import SharedMemoryStore
+from utils.models import ALLOWED_MODELS, COMPUTE_TYPES
+from utils.quality import DEFAULT_QUALITY, PROFILES
+from utils.realtime import RealtimeSession
+from utils import whisper
+from utils.whisper import (
+  TranscriptionInfo,
+  detect_file,
+  start,
+  stream_pcm,
+  stream_upload,
+  transcribe_files,
+  transcribe_pcm,
+  transcribe_upload,
+)
 
 if TYPE_CHECKING:
+  from typing import AsyncIterator
+
+  from faster_whisper.transcribe import Segment
+
+  from multidict import MultiMapping
+
   from utils.extra_request import Request
+  from utils.quality import Profile
+  from utils.whisper import TranscriptionResult
 
 with open("config.toml") as f:
   config = tomllib.loads(f.read())
   frontend_version = config["pages"]["frontend_version"]
   exempt_ips = config["srv"]["ratelimit_exempt"]
   api_version = config["srv"]["api_version"]
+  # Where rate limits are counted: "local" to each process, "shm" shared by
+  # the processes on this host, or "postgres" shared by every replica.
+  ratelimit_config = config.get("ratelimit", {})
+  ratelimit_backend = ratelimit_config.get("backend", "local")
 
-limiter = Limiter(exempt_ips=exempt_ips, use_auth=False)
+UPLOAD_CHUNK_SIZE = 256 * 1024
+ZIP_TYPES = ("application/zip", "application/x-zip-compressed")
+
+limiter = Limiter(
+  exempt_ips=exempt_ips,
+  use_auth=False,
+  store=SharedMemoryStore(
+    ratelimit_config.get("shm_name", "whisper-ratelimit"),
+    slots=ratelimit_config.get("shm_slots", 1 << 16),
+  )
+  if ratelimit_backend == "shm"
+  else None,
+)
 routes = web.RouteTableDef()
 
 
@@ -40,145 +93,554 @@ async def get_lp_get(request: Request) -> Response:
   return web.json_response(packet)
 
 
+@routes.get("/srv/ready/")
+async def get_srv_ready(request: Request) -> Response:
+  "Readiness probe for load balancers: 200 only once the model is warm."
+  status = 200 if whisper.state == "ready" else 503
+  return web.json_response({"status": whisper.state}, status=status)
+
+
+def parse_vad_options(query: MultiMapping[str]) -> dict[str, float]:
+  threshold = float(query.get("vad_threshold", 0.5))
+  min_speech_ms = float(query.get("vad_min_speech", 250))
+  max_speech_s = float(query.get("vad_max_speech", float("inf")))
+  min_silence_ms = float(query.get("vad_min_silence", 2000))
+  speech_pad = float(query.get("vad_speech_pad", 400))
+  return {
+    "onset": threshold,
+    "min_speech_duration_ms": min_speech_ms,
+    "max_speech_duration_s": max_speech_s,
+    "min_silence_duration_ms": min_silence_ms,
+    "speech_pad_ms": speech_pad,
+  }
+
+
+def parse_model_options(query: MultiMapping[str]) -> dict[str, str]:
+  "The model and compute type a request asked for, if any."
+  options = {}
+  if "model" in query:
+    if query["model"] not in ALLOWED_MODELS:
+      raise ValueError(f"model must be one of {', '.join(ALLOWED_MODELS)}")
+    options["model"] = query["model"]
+  if "compute_type" in query:
+    if query["compute_type"] not in COMPUTE_TYPES:
+      raise ValueError(
+        f"compute_type must be one of {', '.join(COMPUTE_TYPES)}"
+      )
+    options["compute_type"] = query["compute_type"]
+  return options
+
+
+def parse_format(query: MultiMapping[str], *, default: str = "text") -> str:
+  """The response format asked for with output=. detailed=true is the old way
+  to ask for json."""
+  if query.get("detailed", "false").lower() == "true":
+    default = "json"
+  fmt = query.get("output", default).lower()
+  if fmt not in FORMATS:
+    raise ValueError(f"output must be one of {', '.join(FORMATS)}")
+  return fmt
+
+
+def parse_quality(query: MultiMapping[str]) -> Profile:
+  "The decoding profile asked for with quality=."
+  quality = query.get("quality", DEFAULT_QUALITY).lower()
+  if quality not in PROFILES:
+    raise ValueError(f"quality must be one of {', '.join(PROFILES)}")
+  return PROFILES[quality]
+
+
+def result_response(
+  result: TranscriptionResult, fmt: str, profile: Profile = None
+) -> Response:
+  "The result in `fmt`, reporting the quality it was decoded at if known."
+  if profile is None:
+    return Response(
+      body=render(result, fmt), headers={"Content-Type": FORMATS[fmt]}
+    )
+  return Response(
+    body=render(result, fmt, quality=profile.name),
+    headers={"Content-Type": FORMATS[fmt], "X-Quality": profile.name},
+  )
+
+
+async def stream_segments(
+  request: Request,
+  items: AsyncIterator[TranscriptionInfo | Segment],
+  profile: Profile,
+) -> StreamResponse:
+  "Write each segment as soon as it is decoded, then a summary record."
+  mode = request.query.get("stream", "").lower()
+  accept = request.headers.get("Accept", "")
+  sse = mode == "sse" or "text/event-stream" in accept
+  resp = StreamResponse(
+    headers={
+      "Content-Type": "text/event-stream" if sse else "application/x-ndjson",
+      "Cache-Control": "no-cache",
+      "X-Quality": profile.name,
+    }
+  )
+
+  async def send(kind: str, packet: dict) -> None:
+    if sse:
+      line = b"event: %s\ndata: %s\n\n" % (kind.encode(), dumps(packet))
+    else:
+      line = dumps({"type": kind, **packet}) + b"\n"
+    await resp.write(line)
+
+  info = None
+  try:
+    async for item in items:
+      if isinstance(item, TranscriptionInfo):
+        info = item
+        # Headers go out once decoding has worked, so failures can still 500.
+        await resp.prepare(request)
+      else:
+        await send("segment", segment_packet(item))
+    await send(
+      "summary",
+      {
+        "language": info.language,
+        "language_probability": info.language_probability,
+        "duration": info.duration,
+        "quality": profile.name,
+      },
+    )
+  except Exception:
+    request.LOG.exception("Failed transcription!")
+    if not resp.prepared:
+      return Response(status=500)
+    await send("error", {"error": "transcription failed"})
+  await resp.write_eof()
+  return resp
+
+
+async def upload_chunks(request: Request) -> AsyncIterator[bytes]:
+  """The uploaded file as it arrives: the body itself, or for multipart forms
+  the "file" field (or else the first file in the form)."""
+  if not request.content_type.startswith("multipart/"):
+    async for chunk in request.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+      yield chunk
+    return
+
+  reader = await request.multipart()
+  while (part := await reader.next()) is not None:
+    if part.name == "file" or part.filename is not None:
+      while chunk := await part.read_chunk(UPLOAD_CHUNK_SIZE):
+        yield chunk
+      return
+  raise ValueError("no file in the form")
+
+
+async def batch_files(request: Request) -> list[tuple[str, bytes]]:
+  """Every file in a batch request, as (name, contents) in the order sent:
+  each file in a multipart form, or each file in a tar or zip body."""
+  if not request.content_type.startswith("multipart/"):
+    body = bytearray()
+    async for chunk in request.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+      body += chunk
+      if len(body) > BATCH_MAX_BYTES:
+        raise BatchTooLargeError("batch is too large")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+      None,
+      functools.partial(
+        unpack_archive,
+        bytes(body),
+        is_zip=request.content_type in ZIP_TYPES,
+      ),
+    )
+
+  files = []
+  total = 0
+  reader = await request.multipart()
+  while (part := await reader.next()) is not None:
+    if part.filename is None and part.name not in ("file", "files"):
+      continue
+    if len(files) >= BATCH_MAX_FILES:
+      raise BatchTooLargeError("batch has too many files")
+    data = bytearray()
+    while chunk := await part.read_chunk(UPLOAD_CHUNK_SIZE):
+      total += len(chunk)
+      if total > BATCH_MAX_BYTES:
+        raise BatchTooLargeError("batch is too large")
+      data += chunk
+    files.append((part.filename or f"{len(files)}", bytes(data)))
+  return files
+
+
 @routes.post("/whisper/transcribe/file/")
 @limiter.limit("6/m")
 async def post_whisper_transcribe_file(request: Request) -> Response:
-  data = await request.read()
-
+  "Any size of audio file, as the body or in a multipart form."
   query = request.query
 
-  detailed = query.get("detailed", "false").lower() == "true"
   vad = query.get("vad", "false").lower() == "true"
-  vad_options = None
-  try:
-    threshold = float(query.get("vad_threshold", 0.5))
-    min_speech_ms = float(query.get("vad_min_speech", 250))
-    max_speech_s = float(query.get("vad_max_speech", float("inf")))
-    min_silence_ms = float(query.get("vad_min_silence", 2000))
-    speech_pad = float(query.get("vad_speech_pad", 400))
-    vad_options = {
-      "threshold": threshold,
-      "min_speech_duration_ms": min_speech_ms,
-      "max_speech_duration_s": max_speech_s,
-      "min_silence_duration_ms": min_silence_ms,
-      "speech_pad_ms": speech_pad,
-    }
+  long = query.get("long", "false").lower() == "true"
+  words = query.get("words", "false").lower() == "true"
+  try:
+    fmt = parse_format(query)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+  try:
+    vad_options = parse_vad_options(query)
   except ValueError:
     return Response(status=400, text="failed converting vad options")
+  try:
+    model_options = parse_model_options(query)
+    profile = parse_quality(query)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
 
+  # Decoding starts with the first bytes, and overlaps the rest of the upload.
+  upload = Upload()
   try:
-    result = await transcribe_file(data, use_vad=vad, vad_options=vad_options)
-    if not detailed:
-      return Response(text=result.full_text)
-    else:
-      segments = []
-      for segment in result.segments:
-        words = []
-        try:
-          for word in segment.words:
-            words.append(
-              {
-                "start": word.start,
-                "end": word.end,
-                "word": word.word,
-                "probability": word.probability,
-              }
-            )
-        except Exception:
-          pass
-
-        segments.append(
-          {
-            "start": segment.start,
-            "end": segment.end,
-            "text": segment.text.strip(),
-            "words": words,
-          }
-        )
-
-      packet = {
-        "full_text": result.full_text,
-        "language": result.language,
-        "language_probability": result.language_prob,
-        "segments": segments,
-        "duration": result.info.duration,
-      }
-      return web.json_response(packet)
+    await upload.receive(upload_chunks(request))
+  except UploadTooLargeError as e:
+    return Response(status=413, text=str(e))
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+
+  # A model or compute type asked for by name wins over the profile's.
+  options = {
+    **profile.options(),
+    "use_vad": vad or profile.use_vad,
+    "vad_options": vad_options,
+    # Subtitles are cut into readable cues between words.
+    "word_timestamps": words or fmt in ("srt", "vtt"),
+    **model_options,
+  }
+  if query.get("stream", "false").lower() in ("true", "sse"):
+    return await stream_segments(
+      request, stream_upload(upload, **options), profile
+    )
+
+  try:
+    result = await transcribe_upload(upload, long=long, **options)
+    return result_response(result, fmt, profile)
   except Exception:
     request.LOG.exception("Failed transcription!")
     return Response(status=500)
 
 
+@routes.post("/whisper/transcribe/batch/")
+@limiter.limit("6/m")
+async def post_whisper_transcribe_batch(request: Request) -> Response:
+  """Many audio files with the same options: as the parts of a multipart
+  form, or as a tar (optionally compressed) or zip body. Results come back
+  in the order the files were sent, with an error in place of any that
+  failed."""
+  query = request.query
+
+  vad = query.get("vad", "false").lower() == "true"
+  long = query.get("long", "false").lower() == "true"
+  words = query.get("words", "false").lower() == "true"
+  try:
+    fmt = parse_format(query, default="json")
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+  try:
+    vad_options = parse_vad_options(query)
+  except ValueError:
+    return Response(status=400, text="failed converting vad options")
+  try:
+    model_options = parse_model_options(query)
+    profile = parse_quality(query)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+
+  try:
+    files = await batch_files(request)
+  except BatchTooLargeError as e:
+    return Response(status=413, text=str(e))
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+  if not files:
+    return Response(status=400, text="no files in the batch")
+
+  options = {
+    **profile.options(),
+    "use_vad": vad or profile.use_vad,
+    "vad_options": vad_options,
+    "word_timestamps": words or fmt in ("srt", "vtt"),
+    **model_options,
+  }
+  results = await transcribe_files(
+    [data for _, data in files], long=long, **options
+  )
+  named = [(name, result) for (name, _), result in zip(files, results)]
+  for name, result in named:
+    if isinstance(result, Exception):
+      request.LOG.warning(f"Failed transcribing {name} in a batch: {result!r}")
+  content_type = FORMATS["msgpack" if fmt == "msgpack" else "json"]
+  return Response(
+    body=render_batch(named, fmt, quality=profile.name),
+    headers={"Content-Type": content_type, "X-Quality": profile.name},
+  )
+
+
 @routes.post("/whisper/transcribe/raw/")
 @limiter.limit("6/m")
 async def post_whisper_transcribe_raw(request: Request) -> Response:
-  data = await request.read()
-
+  "16 kHz mono PCM, as s16le (the default) or f32le, chosen with format=."
   query = request.query
 
-  detailed = query.get("detailed", "false").lower() == "true"
   vad = query.get("vad", "false").lower() == "true"
-  vad_options = None
-  try:
-    threshold = float(query.get("vad_threshold", 0.5))
-    min_speech_ms = float(query.get("vad_min_speech", 250))
-    max_speech_s = float(query.get("vad_max_speech", float("inf")))
-    min_silence_ms = float(query.get("vad_min_silence", 2000))
-    speech_pad = float(query.get("vad_speech_pad", 400))
-    vad_options = {
-      "threshold": threshold,
-      "min_speech_duration_ms": min_speech_ms,
-      "max_speech_duration_s": max_speech_s,
-      "min_silence_duration_ms": min_silence_ms,
-      "speech_pad_ms": speech_pad,
-    }
+  long = query.get("long", "false").lower() == "true"
+  words = query.get("words", "false").lower() == "true"
+  try:
+    fmt = parse_format(query)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+  sample_format = query.get("format", "s16le").lower()
+  if sample_format not in PCM_FORMATS:
+    return Response(status=400, text="format must be s16le or f32le")
+  try:
+    vad_options = parse_vad_options(query)
   except ValueError:
     return Response(status=400, text="failed converting vad options")
+  try:
+    model_options = parse_model_options(query)
+    profile = parse_quality(query)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
 
+  # Read only once the query is known to be good.
   try:
-    result = await transcribe_bytes(data, use_vad=vad, vad_options=vad_options)
-    if not detailed:
-      return Response(text=result.full_text)
-    else:
-      segments = []
-      for segment in result.segments:
-        words = []
-        try:
-          for word in segment.words:
-            words.append(
-              {
-                "start": word.start,
-                "end": word.end,
-                "word": word.word,
-                "probability": word.probability,
-              }
-            )
-        except Exception:
-          pass
-
-        segments.append(
-          {
-            "start": segment.start,
-            "end": segment.end,
-            "text": segment.text.strip(),
-            "words": words,
-          }
-        )
-
-      packet = {
-        "full_text": result.full_text,
-        "language": result.language,
-        "language_probability": result.language_prob,
-        "segments": segments,
-        "duration": result.info.duration,
-      }
-      return web.json_response(packet)
+    audio, digest = await read_pcm(
+      request.content,
+      length=request.content_length,
+      sample_format=sample_format,
+    )
+  except ValueError as e:
+    return Response(status=413, text=str(e))
+
+  options = {
+    **profile.options(),
+    "sample_format": sample_format,
+    "use_vad": vad or profile.use_vad,
+    "vad_options": vad_options,
+    "word_timestamps": words or fmt in ("srt", "vtt"),
+    **model_options,
+  }
+  if query.get("stream", "false").lower() in ("true", "sse"):
+    return await stream_segments(
+      request, stream_pcm(audio, digest, **options), profile
+    )
+
+  try:
+    result = await transcribe_pcm(audio, digest, long=long, **options)
+    return result_response(result, fmt, profile)
   except Exception:
     request.LOG.exception("Failed transcription!")
     return Response(status=500)
 
 
+@routes.post("/whisper/detect/")
+@limiter.limit("30/m")
+async def post_whisper_detect(request: Request) -> Response:
+  """The spoken language of an audio file, from at most its first 30 seconds
+  (or seconds=), or with vad=true its first seconds of speech."""
+  query = request.query
+
+  vad = query.get("vad", "false").lower() == "true"
+  try:
+    seconds = float(query.get("seconds", 30))
+    top = int(query.get("top", 0))
+  except ValueError:
+    return Response(status=400, text="seconds and top must be numbers")
+  if not 1 <= seconds <= 30:
+    return Response(status=400, text="seconds must be between 1 and 30")
+  try:
+    vad_options = parse_vad_options(query)
+  except ValueError:
+    return Response(status=400, text="failed converting vad options")
+  try:
+    model_options = parse_model_options(query)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+
+  if (request.content_length or 0) > DETECT_MAX_BYTES:
+    return Response(status=413, text="upload is too large")
+  chunks = []
+  size = 0
+  try:
+    async for chunk in upload_chunks(request):
+      size += len(chunk)
+      if size > DETECT_MAX_BYTES:
+        return Response(status=413, text="upload is too large")
+      chunks.append(chunk)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+
+  try:
+    languages, duration = await detect_file(
+      b"".join(chunks),
+      seconds=seconds,
+      use_vad=vad,
+      vad_options=vad_options,
+      **model_options,
+    )
+  except Exception:
+    request.LOG.exception("Failed language detection!")
+    return Response(status=500)
+
+  if top > 0:
+    languages = languages[:top]
+  language, probability = languages[0] if languages else (None, 0.0)
+  packet = {
+    "language": language,
+    "language_probability": probability,
+    "languages": [
+      {"language": code, "probability": prob} for code, prob in languages
+    ],
+    "duration": duration,
+  }
+  return web.json_response(packet)
+
+
+@routes.get("/whisper/stream/")
+@limiter.limit("6/m")
+async def get_whisper_stream(request: Request) -> web.WebSocketResponse:
+  """Live transcription. Send 16 kHz mono s16le PCM as binary frames, and a
+  "stop" text frame (or close) to flush. Receives partial and final JSON."""
+  ws = web.WebSocketResponse(heartbeat=30)
+  await ws.prepare(request)
+  session = RealtimeSession()
+
+  try:
+    async for msg in ws:
+      if msg.type == WSMsgType.BINARY:
+        session.feed(msg.data)
+        if session.ready:
+          for message in await session.process():
+            await ws.send_json(message)
+      elif msg.type == WSMsgType.TEXT and msg.data.strip().lower() == "stop":
+        break
+      elif msg.type == WSMsgType.ERROR:
+        break
+
+    if not ws.closed:
+      for message in await session.process(final=True):
+        await ws.send_json(message)
+  except Exception:
+    request.LOG.exception("Failed live transcription!")
+  finally:
+    await ws.close()
+  return ws
+
+
+@routes.post("/whisper/jobs/")
+@limiter.limit("6/m")
+async def post_whisper_jobs(request: Request) -> Response:
+  if job_queue.pool is None:
+    return Response(status=503, text="job queue needs postgresql")
+
+  query = request.query
+
+  source = query.get("source", "file").lower()
+  if source not in ("file", "raw"):
+    return Response(status=400, text="source must be file or raw")
+  vad = query.get("vad", "false").lower() == "true"
+  long = query.get("long", "false").lower() == "true"
+  words = query.get("words", "false").lower() == "true"
+  try:
+    vad_options = parse_vad_options(query)
+  except ValueError:
+    return Response(status=400, text="failed converting vad options")
+  try:
+    model_options = parse_model_options(query)
+    profile = parse_quality(query)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+
+  # Spooled to disk as it arrives, like any other upload, so a long
+  # recording isn't held to the request body limit.
+  upload = Upload(limit=JOB_MAX_BYTES)
+  try:
+    await upload.receive(upload_chunks(request), decode=False)
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, upload.read)
+  except UploadTooLargeError as e:
+    return Response(status=413, text=str(e))
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+  finally:
+    upload.file.close()
+
+  job_id = await job_queue.submit(
+    source,
+    data,
+    {
+      **profile.options(),
+      "use_vad": vad or profile.use_vad,
+      "vad_options": vad_options,
+      "long": long,
+      "word_timestamps": words,
+      **model_options,
+    },
+  )
+  return web.json_response(
+    {"id": job_id, "status": "queued", "quality": profile.name}, status=202
+  )
+
+
+@routes.get("/whisper/jobs/{job_id}/")
+@limiter.limit("60/m")
+async def get_whisper_job(request: Request) -> Response:
+  if job_queue.pool is None:
+    return Response(status=503, text="job queue needs postgresql")
+
+  try:
+    job = await job_queue.status(request.match_info["job_id"])
+  except ValueError:
+    return Response(status=400, text="invalid job id")
+  if job is None:
+    return Response(status=404, text="no such job")
+
+  packet = {
+    "id": str(job["id"]),
+    "status": job["status"],
+    "error": job["error"],
+    "attempts": job["attempts"],
+  }
+  for key in ("created", "started", "finished"):
+    packet[key] = job[key].isoformat() if job[key] else None
+  return web.json_response(packet)
+
+
+@routes.get("/whisper/jobs/{job_id}/result/")
+@limiter.limit("60/m")
+async def get_whisper_job_result(request: Request) -> Response:
+  if job_queue.pool is None:
+    return Response(status=503, text="job queue needs postgresql")
+
+  try:
+    fmt = parse_format(request.query)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+  try:
+    result = await job_queue.result(request.match_info["job_id"])
+  except ValueError:
+    return Response(status=400, text="invalid job id")
+  if result is None:
+    return Response(status=404, text="job not finished or not found")
+  return result_response(result, fmt)
+
+
 async def setup(app: web.Application) -> None:
+  await start(pool=app.pool if app.POSTGRES_ENABLED else None)
+  if app.POSTGRES_ENABLED:
+    await job_queue.start(app.pool)
+  if ratelimit_backend == "postgres":
+    if app.POSTGRES_ENABLED:
+      await limiter.attach(
+        app.pool,
+        lease_divisor=ratelimit_config.get("lease_divisor", 10),
+        min_lease=ratelimit_config.get("min_lease", 3),
+      )
+    else:
+      app.LOG.warning("ratelimit.backend is postgres, but postgres is off")
   for route in routes:
     app.LOG.info(f"  ↳ {route}")
   app.add_routes(routes)
@@ -14,6 +14,7 @@ from aiohttp import web
 
 from utils.get_routes import get_module
 from utils.logger import CustomWebLogger
+from utils.metrics import get_metrics, metrics_middleware
 from utils.pg_pool_middleware import pg_pool_middleware
 
 LOGFMT = "[%(filename)s][%(asctime)s][%(levelname)s] %(message)s"
@@ -43,9 +44,11 @@ coloredlogs.install(
 
 LOG = logging.getLogger(__name__)
 
+# The metrics middleware sees requests to the sub apps as well.
 app = web.Application(
   logger = CustomWebLogger(LOG),
   middlewares=[
+    metrics_middleware,
     pg_pool_middleware
   ],
   client_max_size=(1024**2)*32 # 32MB
@@ -95,6 +98,7 @@ async def startup():
           LOG.exception(f"Failed to load cog {cog}!")
 
     app.add_subapp("/api/", api_app)
+    app.router.add_get("/metrics", get_metrics)
 
     LOG.info("Loading frontend...")
     try:
@@ -124,7 +128,10 @@ async def startup():
     try: await session.close()   # noqa: E701
     except: pass  # noqa: E722, E701
 
-try:
-  uvloop.run(startup(), debug=True)
-except KeyboardInterrupt:
-  print("Server shut down.")
\ No newline at end of file
+# Inference workers are spawned processes that re-import this module, so the
+# server must only start when run directly.
+if __name__ == "__main__":
+  try:
+    uvloop.run(startup(), debug=True)
+  except KeyboardInterrupt:
+    print("Server shut down.")
\ No newline at end of file
@@ -0,0 +1,246 @@
+# Find the fastest compute type, worker and thread counts for this host
+#
+# Run from src/ on the machine that will serve, with nothing else busy:
+#   python -m tools.autotune
+# Every combination runs the configured model over the same synthetic corpus,
+# with each worker process transcribing all of it at once, as a saturated
+# server would. The fastest is written to the tuning file (model.tuning_file,
+# tuning.toml by default), which the server reads at startup for whichever of
+# compute_type, workers and cpu_threads config.toml doesn't set.
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from tools.benchmark import SAMPLE_RATE, git_commit, int_list, synthesize
+
+if TYPE_CHECKING:
+  from multiprocessing.queues import Queue
+  from multiprocessing.synchronize import Barrier
+  from typing import Any
+
+  import numpy
+
+# Spawned, like the server's own workers, so each loads its model from scratch.
+ctx = multiprocessing.get_context("spawn")
+
+
+def _worker(
+  compute_type: str,
+  cpu_threads: int,
+  corpus: list[numpy.ndarray],
+  barrier: Barrier,
+  results: Queue,
+) -> None:
+  "Load the model, wait for the others, then time one pass over the corpus."
+  try:
+    from utils import whisper
+
+    whisper.registry.cpu_threads = cpu_threads
+    whisper.registry.get(whisper.MODEL_SIZE, compute_type)
+
+    def run(clips: list[numpy.ndarray]) -> None:
+      for i in range(0, len(clips), whisper.MAX_BATCH_SIZE):
+        jobs = [
+          whisper.TranscriptionJob(clip, compute_type=compute_type)
+          for clip in clips[i : i + whisper.MAX_BATCH_SIZE]
+        ]
+        for result in whisper._transcribe_batch(jobs):
+          if isinstance(result, Exception):
+            raise result
+
+    run(corpus[:1])
+  except Exception as e:
+    barrier.abort()
+    results.put(repr(e))
+    return
+
+  try:
+    barrier.wait()
+    start = time.perf_counter()
+    run(corpus)
+  except threading.BrokenBarrierError:
+    results.put("another worker failed")
+    return
+  except Exception as e:
+    results.put(repr(e))
+    return
+  results.put(time.perf_counter() - start)
+
+
+def measure(
+  compute_type: str,
+  workers: int,
+  cpu_threads: int,
+  corpus: list[numpy.ndarray],
+  *,
+  timeout: float,
+) -> float:
+  """Seconds of audio transcribed per second across `workers` processes of
+  `cpu_threads` threads each. Raises RuntimeError if any of them failed,
+  or didn't finish within `timeout` seconds."""
+  barrier = ctx.Barrier(workers)
+  results = ctx.Queue()
+  processes = [
+    ctx.Process(
+      target=_worker,
+      args=(compute_type, cpu_threads, corpus, barrier, results),
+      daemon=True,
+    )
+    for _ in range(workers)
+  ]
+  for process in processes:
+    process.start()
+  try:
+    elapsed = [results.get(timeout=timeout) for _ in processes]
+  except queue.Empty:
+    raise RuntimeError("timed out, or a worker died") from None
+  finally:
+    for process in processes:
+      process.join(5)
+      if process.is_alive():
+        process.kill()
+
+  errors = [value for value in elapsed if isinstance(value, str)]
+  if errors:
+    raise RuntimeError(errors[0])
+  audio_seconds = sum(clip.shape[0] for clip in corpus) / SAMPLE_RATE
+  return audio_seconds * workers / max(elapsed)
+
+
+def candidates(
+  workers: list[int], threads: list[int] | None, cores: int
+) -> list[tuple[int, int]]:
+  "(workers, threads) pairs that don't ask for more threads than cores."
+  pairs = []
+  for count in workers:
+    if count > cores:
+      continue
+    options = threads or [cores // count]
+    pairs.extend((count, each) for each in options if count * each <= cores)
+  return pairs
+
+
+def write_tuning(path: str, best: dict[str, Any], model: dict) -> None:
+  # One worker runs just as well inside the server process, without the
+  # round trip through a pipe.
+  workers = 0 if best["workers"] == 1 else best["workers"]
+  with open(path, "w") as f:
+    f.write(
+      f"# Written by python -m tools.autotune on {platform.node()} at "
+      f"{time.strftime('%Y-%m-%dT%H:%M:%S%z')}.\n"
+      f"# Settings in config.toml take precedence over these.\n"
+      f"[model]\n"
+      f"model = {json.dumps(model['model'])}\n"
+      f"device = {json.dumps(model['device'])}\n"
+      f"compute_type = {json.dumps(best['compute_type'])}\n"
+      f"workers = {workers}\n"
+      f"cpu_threads = {best['cpu_threads']}\n"
+      f"real_time_factor = {best['real_time_factor']:.2f}\n"
+    )
+
+
+def main(args: argparse.Namespace) -> dict[str, Any]:
+  from utils.models import DEVICE, MODEL_SIZE, TUNING_FILE
+
+  cores = os.cpu_count()
+  corpus = [
+    synthesize(args.seconds, seed)
+    for seed in range(args.seed, args.seed + args.clips)
+  ]
+  pairs = candidates(args.workers, args.threads, cores)
+  print(
+    f"Tuning {MODEL_SIZE} on {DEVICE} with {cores} cores: "
+    f"{len(args.compute_types) * len(pairs)} combinations of "
+    f"{args.clips} x {args.seconds:g}s clips"
+  )
+
+  trials = []
+  for compute_type in args.compute_types:
+    for workers, cpu_threads in pairs:
+      trial = {
+        "compute_type": compute_type,
+        "workers": workers,
+        "cpu_threads": cpu_threads,
+      }
+      try:
+        trial["real_time_factor"] = measure(
+          compute_type, workers, cpu_threads, corpus, timeout=args.timeout
+        )
+        note = f"{trial['real_time_factor']:7.2f}x real time"
+      except RuntimeError as e:
+        trial["error"] = str(e)
+        note = f"failed: {e}"
+      trials.append(trial)
+      print(
+        f"  {compute_type:>12}  {workers:3} workers  "
+        f"{cpu_threads:3} threads  {note}"
+      )
+
+  timed = [trial for trial in trials if "real_time_factor" in trial]
+  if not timed:
+    raise SystemExit("Every combination failed, nothing written")
+  best = max(timed, key=lambda trial: trial["real_time_factor"])
+  out = args.out or TUNING_FILE
+  write_tuning(out, best, {"model": MODEL_SIZE, "device": DEVICE})
+  print(
+    f"Fastest: {best['compute_type']}, {best['workers']} workers of "
+    f"{best['cpu_threads']} threads. Wrote {out}"
+  )
+  return {
+    "commit": git_commit(),
+    "machine": {
+      "platform": platform.platform(),
+      "processor": platform.processor(),
+      "cores": cores,
+    },
+    "best": best,
+    "trials": trials,
+  }
+
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(
+    description="Benchmark compute types, workers and threads on this host, "
+    "and write the fastest to the tuning file."
+  )
+  parser.add_argument(
+    "--compute-types",
+    type=lambda value: value.split(","),
+    default=["int8", "int8_float32", "float32"],
+  )
+  parser.add_argument("--workers", type=int_list, default=[1, 2, 4, 8])
+  parser.add_argument(
+    "--threads",
+    type=int_list,
+    help="per worker (default: the cores split evenly between workers)",
+  )
+  parser.add_argument("--clips", type=int, default=8)
+  parser.add_argument(
+    "--seconds", type=float, default=20.0, help="audio seconds per clip"
+  )
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument(
+    "--timeout", type=float, default=1800, help="per combination, in seconds"
+  )
+  parser.add_argument(
+    "--out", help="tuning file to write (default: model.tuning_file)"
+  )
+  parser.add_argument("--report", help="also write every trial here as JSON")
+  return parser.parse_args()
+
+
+if __name__ == "__main__":
+  args = parse_args()
+  results = main(args)
+  if args.report:
+    with open(args.report, "w") as f:
+      json.dump(results, f, indent=2)
+    print(f"Wrote {args.report}")
@@ -0,0 +1,388 @@
+# Load and latency benchmark for the transcription endpoints
+#
+# Run from src/ against a running server, e.g. one configured with
+# model = "tiny" and device = "cpu" for an offline CPU-only run:
+#   python -m tools.benchmark --concurrency 1,4,8 --out bench.json
+# The client's address should be in srv.ratelimit_exempt, otherwise the 6/m
+# limit on the transcribe routes dominates every number.
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import json
+import platform
+import subprocess
+import time
+import tomllib
+from ipaddress import ip_address, ip_network
+from typing import TYPE_CHECKING
+
+import aiohttp
+import av
+import numpy
+
+if TYPE_CHECKING:
+  from typing import Any
+
+SAMPLE_RATE = 16000
+
+# container -> (format, codec, sample format). Containers whose encoder the
+# local PyAV build lacks are skipped with a warning.
+CONTAINERS = {
+  "wav": ("wav", "pcm_s16le", "s16"),
+  "flac": ("flac", "flac", "s16"),
+  "mp3": ("mp3", "libmp3lame", "fltp"),
+  "ogg": ("ogg", "libopus", "flt"),
+  "m4a": ("ipod", "aac", "fltp"),
+}
+
+# Histograms from /metrics whose totals are compared before and after a run.
+SERVER_HISTOGRAMS = (
+  "whisper_queue_wait_seconds",
+  "whisper_decode_seconds",
+  "whisper_inference_seconds",
+  "whisper_batch_size",
+  "whisper_real_time_factor",
+)
+
+
+def synthesize(seconds: float, seed: int) -> numpy.ndarray:
+  """Speech-like audio: a buzzy voice with a wandering pitch and formants,
+  chopped into syllables and phrases, over a little background noise. It
+  won't produce sensible text, but it keeps VAD and the decoder busy the
+  way speech does, and is identical for a given seed."""
+  rng = numpy.random.default_rng(seed)
+  n = int(seconds * SAMPLE_RATE)
+  t = numpy.arange(n) / SAMPLE_RATE
+
+  # Pitch drifting between about 90 and 220 Hz.
+  pitch = 150 + 50 * numpy.sin(2 * numpy.pi * 0.3 * t + rng.uniform(0, 6))
+  pitch += 20 * numpy.sin(2 * numpy.pi * 2.1 * t)
+  phase = 2 * numpy.pi * numpy.cumsum(pitch) / SAMPLE_RATE
+  voice = sum(numpy.sin(k * phase) / k for k in range(1, 16))
+
+  # Two formants sweeping like changing vowels.
+  for low, high, rate in ((300, 900, 3.0), (900, 2500, 4.3)):
+    formant = low + (high - low) * (
+      0.5 + 0.5 * numpy.sin(2 * numpy.pi * rate * t)
+    )
+    voice *= 0.6 + 0.4 * numpy.sin(
+      2 * numpy.pi * numpy.cumsum(formant) / SAMPLE_RATE
+    )
+
+  # Syllables at about 4 Hz, and phrases of a few seconds split by pauses.
+  syllables = numpy.clip(numpy.sin(2 * numpy.pi * 4 * t), 0, None) ** 0.5
+  phrases = numpy.ones(n)
+  position = 0
+  while position < n:
+    position += int(rng.uniform(1.5, 5) * SAMPLE_RATE)
+    pause = int(rng.uniform(0.3, 1.2) * SAMPLE_RATE)
+    phrases[position : position + pause] = 0
+    position += pause
+
+  audio = voice * syllables * phrases
+  audio /= numpy.abs(audio).max() or 1
+  audio = 0.5 * audio + 0.005 * rng.standard_normal(n)
+  return audio.astype(numpy.float32)
+
+
+def variants(
+  audio: numpy.ndarray, count: int, seed: int
+) -> list[numpy.ndarray]:
+  """Copies of `audio` with inaudibly different dither, so every request is a
+  cache miss on the server and measures a real transcription."""
+  rng = numpy.random.default_rng(seed)
+  return [
+    audio + (1e-4 * rng.standard_normal(audio.shape[0])).astype(numpy.float32)
+    for _ in range(count)
+  ]
+
+
+def to_pcm(audio: numpy.ndarray) -> bytes:
+  return (numpy.clip(audio, -1, 1) * 32767).astype(numpy.int16).tobytes()
+
+
+def encode(audio: numpy.ndarray, container: str) -> bytes:
+  "Encode mono float32 audio into one of CONTAINERS with PyAV."
+  fmt, codec, sample_format = CONTAINERS[container]
+  buffer = io.BytesIO()
+  with av.open(buffer, mode="w", format=fmt) as output:
+    rate = 48000 if codec == "libopus" else SAMPLE_RATE
+    stream = output.add_stream(codec, rate=rate)
+    stream.layout = "mono"
+    resampler = av.AudioResampler(
+      format=sample_format, layout="mono", rate=rate
+    )
+
+    frame = av.AudioFrame.from_ndarray(
+      audio.reshape(1, -1), format="flt", layout="mono"
+    )
+    frame.sample_rate = SAMPLE_RATE
+    for resampled in resampler.resample(frame) + resampler.resample(None):
+      resampled.pts = None
+      output.mux(stream.encode(resampled))
+    output.mux(stream.encode(None))
+  return buffer.getvalue()
+
+
+def percentile(values: list[float], q: float) -> float | None:
+  if not values:
+    return None
+  return float(numpy.percentile(values, q))
+
+
+def parse_metrics(text: str) -> dict[str, float]:
+  "The _sum and _count of each histogram we care about, summed over labels."
+  totals: dict[str, float] = {}
+  for line in text.splitlines():
+    if line.startswith("#") or not line.strip():
+      continue
+    name, _, value = line.rpartition(" ")
+    name = name.split("{", 1)[0]
+    for histogram in SERVER_HISTOGRAMS:
+      if name in (f"{histogram}_sum", f"{histogram}_count"):
+        totals[name] = totals.get(name, 0) + float(value)
+  return totals
+
+
+async def scrape(session: aiohttp.ClientSession, url: str) -> dict[str, float]:
+  try:
+    async with session.get(f"{url}/metrics") as resp:
+      if resp.status != 200:
+        return {}
+      return parse_metrics(await resp.text())
+  except aiohttp.ClientError:
+    return {}
+
+
+def server_breakdown(
+  before: dict[str, float], after: dict[str, float]
+) -> dict[str, Any]:
+  "What each server-side histogram recorded during the run."
+  breakdown = {}
+  for histogram in SERVER_HISTOGRAMS:
+    count = after.get(f"{histogram}_count", 0) - before.get(
+      f"{histogram}_count", 0
+    )
+    total = after.get(f"{histogram}_sum", 0) - before.get(f"{histogram}_sum", 0)
+    name = histogram.removeprefix("whisper_")
+    breakdown[name] = {
+      "count": count,
+      "mean": total / count if count else None,
+      "total": total,
+    }
+  return breakdown
+
+
+async def run_case(
+  session: aiohttp.ClientSession,
+  url: str,
+  *,
+  endpoint: str,
+  payloads: list[bytes],
+  audio_seconds: float,
+  concurrency: int,
+  params: dict[str, str],
+) -> dict[str, Any]:
+  "Post every payload once, keeping `concurrency` requests open."
+  latencies: list[float] = []
+  statuses: dict[int, int] = {}
+  pending = list(payloads)
+
+  async def worker() -> None:
+    while pending:
+      payload = pending.pop()
+      start = time.perf_counter()
+      try:
+        async with session.post(
+          f"{url}/api/whisper/transcribe/{endpoint}/",
+          data=payload,
+          params=params,
+        ) as resp:
+          await resp.read()
+          status = resp.status
+      except aiohttp.ClientError:
+        status = 0
+      statuses[status] = statuses.get(status, 0) + 1
+      if status == 200:
+        latencies.append(time.perf_counter() - start)
+
+  before = await scrape(session, url)
+  start = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  elapsed = time.perf_counter() - start
+  after = await scrape(session, url)
+
+  succeeded = len(latencies)
+  return {
+    "requests": len(payloads),
+    "succeeded": succeeded,
+    "statuses": {str(status): count for status, count in statuses.items()},
+    "elapsed_s": elapsed,
+    "throughput_rps": succeeded / elapsed,
+    "real_time_factor": succeeded * audio_seconds / elapsed,
+    "latency_s": {
+      "p50": percentile(latencies, 50),
+      "p95": percentile(latencies, 95),
+      "p99": percentile(latencies, 99),
+      "mean": sum(latencies) / succeeded if succeeded else None,
+    },
+    "server": server_breakdown(before, after),
+  }
+
+
+def git_commit() -> str | None:
+  try:
+    return subprocess.run(
+      ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def limiter_exempt(config: dict, host: str) -> bool:
+  "Whether requests from `host` skip the rate limit, as far as we can tell."
+  try:
+    client = ip_address(host)
+  except ValueError:
+    return False
+  for exempt in config.get("srv", {}).get("ratelimit_exempt", []):
+    try:
+      if client in ip_network(exempt):
+        return True
+    except ValueError:
+      continue
+  return False
+
+
+def int_list(value: str) -> list[int]:
+  return [int(item) for item in value.split(",")]
+
+
+def float_list(value: str) -> list[float]:
+  return [float(item) for item in value.split(",")]
+
+
+async def main(args: argparse.Namespace) -> dict[str, Any]:
+  with open(args.config) as f:
+    config = tomllib.loads(f.read())
+  url = args.url or f"http://127.0.0.1:{config['srv']['port']}"
+  if not limiter_exempt(config, args.client_ip):
+    print(
+      f"warning: {args.client_ip} is not in srv.ratelimit_exempt, expect 429s"
+    )
+
+  seed = args.seed
+  params = {}
+  if args.vad:
+    params["vad"] = "true"
+
+  cases = []
+  timeout = aiohttp.ClientTimeout(total=args.timeout)
+  connector = aiohttp.TCPConnector(limit=0)
+  async with aiohttp.ClientSession(
+    timeout=timeout, connector=connector
+  ) as session:
+    for seconds in args.lengths:
+      for endpoint, container in [("raw", "s16le")] + [
+        ("file", container) for container in args.containers
+      ]:
+        for concurrency in args.concurrency:
+          seed += 1
+          audio = synthesize(seconds, seed)
+          requests = args.requests or concurrency * 4
+          try:
+            payloads = [
+              to_pcm(variant)
+              if endpoint == "raw"
+              else encode(variant, container)
+              for variant in variants(audio, requests, seed)
+            ]
+          except (av.error.FFmpegError, ValueError) as e:
+            print(f"warning: skipping {container}, encoding failed: {e}")
+            break
+
+          case = await run_case(
+            session,
+            url,
+            endpoint=endpoint,
+            payloads=payloads,
+            audio_seconds=seconds,
+            concurrency=concurrency,
+            params=params,
+          )
+          case = {
+            "endpoint": endpoint,
+            "container": container,
+            "audio_s": seconds,
+            "payload_bytes": len(payloads[0]),
+            "concurrency": concurrency,
+            **case,
+          }
+          cases.append(case)
+          latency = case["latency_s"]
+          print(
+            f"{endpoint:>4} {container:>5} {seconds:>6.1f}s x{concurrency:<3} "
+            f"{case['throughput_rps']:7.2f} req/s  "
+            f"rtf {case['real_time_factor']:7.2f}  "
+            f"p50 {latency['p50'] or 0:6.3f}s  "
+            f"p99 {latency['p99'] or 0:6.3f}s  "
+            f"ok {case['succeeded']}/{case['requests']}"
+          )
+
+  return {
+    "commit": git_commit(),
+    "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "url": url,
+    "machine": {
+      "platform": platform.platform(),
+      "python": platform.python_version(),
+      "processor": platform.processor(),
+    },
+    "model": config.get("model", {}),
+    "cases": cases,
+  }
+
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(
+    description="Load and latency benchmark for the transcription endpoints."
+  )
+  parser.add_argument(
+    "--url", help="server to benchmark (default: from config)"
+  )
+  parser.add_argument("--config", default="config.toml")
+  parser.add_argument(
+    "--client-ip",
+    default="127.0.0.1",
+    help="address the server sees us as, checked against ratelimit_exempt",
+  )
+  parser.add_argument("--concurrency", type=int_list, default=[1, 4])
+  parser.add_argument(
+    "--lengths", type=float_list, default=[5.0, 30.0], help="audio seconds"
+  )
+  parser.add_argument(
+    "--containers",
+    type=lambda value: value.split(","),
+    default=list(CONTAINERS),
+  )
+  parser.add_argument(
+    "--requests", type=int, help="per case (default: 4 x concurrency)"
+  )
+  parser.add_argument("--vad", action="store_true")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--timeout", type=float, default=600)
+  parser.add_argument("--out", help="write the results here as JSON")
+  return parser.parse_args()
+
+
+if __name__ == "__main__":
+  args = parse_args()
+  results = asyncio.run(main(args))
+  if args.out:
+    with open(args.out, "w") as f:
+      json.dump(results, f, indent=2)
+    print(f"Wrote {args.out}")
+  else:
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,447 @@
+# Decode uploaded audio into 16 kHz mono float32 arrays for the model
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import random
+import string
+import tarfile
+import tempfile
+import threading
+import time
+import tomllib
+import wave
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import aiofiles
+import aiofiles.os
+import av
+import numpy
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+from utils.metrics import DECODE_SECONDS
+
+if TYPE_CHECKING:
+  from typing import AsyncIterator, BinaryIO, Callable
+
+  from aiohttp import StreamReader
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+
+SAMPLE_RATE = 16000
+DECODE_THREADS = config.get("audio", {}).get(
+  "decode_threads", min(4, os.cpu_count())
+)
+# Largest raw PCM upload, which is read outside aiohttp's client_max_size.
+RAW_MAX_BYTES = config.get("audio", {}).get("raw_max_mb", 32) * 1024**2
+# Largest upload to the language detection endpoint, which reads it into
+# memory. Detection only needs the start of a file, so this stays small.
+DETECT_MAX_BYTES = config.get("audio", {}).get("detect_max_mb", 16) * 1024**2
+
+# Largest file upload. These are spooled to disk, so this only bounds disk use.
+UPLOAD_MAX_BYTES = config.get("audio", {}).get("upload_max_mb", 4096) * 1024**2
+# Decoders of uploads still arriving mostly wait on the network, so they get
+# their own threads rather than holding up decode_pool.
+UPLOAD_THREADS = config.get("audio", {}).get("upload_threads", 32)
+SPOOL_DIR = "/tmp/audioconversion/"
+# Batch requests are held in memory while their files are transcribed.
+BATCH_MAX_BYTES = config.get("audio", {}).get("batch_max_mb", 256) * 1024**2
+BATCH_MAX_FILES = config.get("audio", {}).get("batch_max_files", 256)
+
+# Raw sample formats the raw endpoint takes, and their scale to [-1, 1).
+PCM_FORMATS = {
+  "s16le": (numpy.dtype("<i2"), 1 / 32768.0),
+  "f32le": (numpy.dtype("<f4"), None),
+}
+
+LOG = logging.getLogger(__name__)
+
+# PyAV releases the GIL while decoding, so a small pool keeps decodes off the
+# event loop without letting a burst of uploads starve the model of CPU.
+decode_pool = ThreadPoolExecutor(
+  max_workers=DECODE_THREADS, thread_name_prefix="decode"
+)
+upload_pool = ThreadPoolExecutor(
+  max_workers=UPLOAD_THREADS, thread_name_prefix="upload"
+)
+
+
+def _decode_pyav(
+  data: bytes | BinaryIO, max_seconds: float = None
+) -> numpy.ndarray:
+  """Decode an audio file held in memory, or read from a file object. With
+  `max_seconds`, decoding stops once that much audio has come out."""
+  resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+  chunks: list[numpy.ndarray] = []
+  if isinstance(data, bytes):
+    data = io.BytesIO(data)
+  limit = int(max_seconds * SAMPLE_RATE) if max_seconds is not None else None
+  decoded = 0
+
+  # Packet by packet, so a corrupt one is dropped and decoding carries on
+  # with the next, where an error out of container.decode() would end it.
+  skipped = 0
+  with av.open(data, mode="r", metadata_errors="ignore") as container:
+    if not container.streams.audio:
+      raise ValueError("no audio stream")
+    for packet in container.demux(container.streams.audio[0]):
+      try:
+        frames = packet.decode()
+      except av.error.InvalidDataError:
+        skipped += 1
+        continue
+      for frame in frames:
+        for resampled in resampler.resample(frame):
+          chunks.append(resampled.to_ndarray().reshape(-1))
+          decoded += chunks[-1].shape[0]
+      if limit is not None and decoded >= limit:
+        break
+    for resampled in resampler.resample(None):
+      chunks.append(resampled.to_ndarray().reshape(-1))
+
+  if skipped:
+    LOG.warning(f"Skipped {skipped} corrupt packets decoding audio")
+  if not chunks:
+    if skipped:
+      # Nothing good in it at all, so let ffmpeg have a go.
+      raise ValueError("no packet could be decoded")
+    return numpy.zeros(0, dtype=numpy.float32)
+  return numpy.concatenate(chunks)[:limit]
+
+
+def _read_wav(file_path: str) -> numpy.ndarray:
+  with wave.open(file_path, "rb") as wav:
+    pcm = wav.readframes(wav.getnframes())
+  audio = numpy.frombuffer(pcm, numpy.int16).astype(numpy.float32)
+  audio *= 1 / 32768.0
+  return audio
+
+
+async def read_pcm(
+  content: StreamReader, *, length: int | None, sample_format: str = "s16le"
+) -> tuple[numpy.ndarray, str]:
+  """Read raw 16 kHz mono PCM from a request body straight into a float32
+  array, converting each chunk as it arrives, so the body is never held
+  twice. Returns the audio and a digest of the bytes, for the cache."""
+  dtype, scale = PCM_FORMATS[sample_format]
+  if length is None:
+    # Pages of the buffer past what gets filled are never touched, so this
+    # costs address space rather than memory.
+    length = RAW_MAX_BYTES
+  elif length > RAW_MAX_BYTES:
+    raise ValueError("request body too large")
+
+  audio = numpy.empty(length // dtype.itemsize, dtype=numpy.float32)
+  digest = hashlib.blake2b(digest_size=32)
+  filled = 0
+  carry = b""
+  while True:
+    chunk = await content.readany()
+    if not chunk:
+      break
+    digest.update(chunk)
+    if carry:
+      chunk = carry + chunk
+    usable = len(chunk) - len(chunk) % dtype.itemsize
+    carry = chunk[usable:]
+    count = usable // dtype.itemsize
+    if filled + count > audio.shape[0]:
+      raise ValueError("request body longer than its Content-Length")
+    samples = numpy.frombuffer(chunk, dtype=dtype, count=count)
+    out = audio[filled : filled + count]
+    if scale is None:
+      out[:] = samples
+    else:
+      numpy.multiply(samples, scale, out=out, casting="unsafe")
+    filled += count
+
+  return audio[:filled], digest.hexdigest()
+
+
+async def detect_speech(
+  audio: numpy.ndarray, vad_options: VadOptions
+) -> list[dict[str, int]]:
+  "Sample ranges of `audio` that contain speech, found with Silero VAD."
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(
+    decode_pool, get_speech_timestamps, audio, vad_options
+  )
+
+
+async def decode(data: bytes, *, max_seconds: float = None) -> numpy.ndarray:
+  """Turn an uploaded audio file into a 16 kHz mono float32 array, or just
+  its first `max_seconds`."""
+  with DECODE_SECONDS.time():
+    return await _decode(data, max_seconds)
+
+
+async def _decode(data: bytes, max_seconds: float = None) -> numpy.ndarray:
+  loop = asyncio.get_running_loop()
+  try:
+    return await loop.run_in_executor(
+      decode_pool, _decode_pyav, data, max_seconds
+    )
+  except (av.error.FFmpegError, ValueError):
+    LOG.warning("In-process decode failed, falling back to ffmpeg")
+
+  file_path = await convert_to_wav(data)
+  try:
+    audio = await loop.run_in_executor(decode_pool, _read_wav, file_path)
+    if max_seconds is not None:
+      audio = audio[: int(max_seconds * SAMPLE_RATE)]
+    return audio
+  finally:
+    await aiofiles.os.remove(file_path)
+
+
+async def convert_to_wav(data: bytes) -> str:
+  "Convert an audio file to wav by saving it as a temporary file and using ffmpeg to convert it."
+  pool: str = string.ascii_letters + string.digits
+  job_id = "".join(random.choices(pool, k=32))
+
+  await aiofiles.os.makedirs(SPOOL_DIR, exist_ok=True)
+
+  async with aiofiles.open(f"{SPOOL_DIR}{job_id}.src", "wb") as f:
+    await f.write(data)
+
+  try:
+    return await _ffmpeg_to_wav(f"{SPOOL_DIR}{job_id}.src")
+  finally:
+    await aiofiles.os.remove(f"{SPOOL_DIR}{job_id}.src")
+
+
+async def _ffmpeg_to_wav(source: str) -> str:
+  "Convert the audio file at `source` to a temporary wav file with ffmpeg."
+  pool: str = string.ascii_letters + string.digits
+  job_id = "".join(random.choices(pool, k=32))
+
+  proc = await asyncio.create_subprocess_exec(
+    "ffmpeg",
+    "-i",
+    source,
+    "-vn",
+    "-acodec",
+    "pcm_s16le",
+    "-ar",
+    str(SAMPLE_RATE),
+    "-ac",
+    "1",
+    f"{SPOOL_DIR}{job_id}.wav",
+  )
+
+  returncode = await proc.wait()
+
+  if returncode != 0:
+    raise Exception("Failed to convert audio file.")
+
+  return f"{SPOOL_DIR}{job_id}.wav"
+
+
+class UploadAbortedError(OSError):
+  pass
+
+
+class UploadTooLargeError(ValueError):
+  pass
+
+
+class _SpoolReader:
+  """A file object over an upload's spool file for the decoder. Reads past
+  what has arrived so far block until more arrives, so the decoder can seek
+  freely (for formats such as mp4 that keep their index at the end) while
+  decoding everything else as soon as it is uploaded."""
+
+  def __init__(self, upload: Upload) -> None:
+    self.upload = upload
+    self.position = 0
+
+  def _wait(self, until: Callable[[], bool]) -> None:
+    upload = self.upload
+    with upload.changed:
+      while not (until() or upload.finished or upload.aborted):
+        upload.changed.wait()
+      if upload.aborted:
+        raise UploadAbortedError("upload aborted")
+
+  def read(self, size: int = -1) -> bytes:
+    upload = self.upload
+    if size < 0:
+      self._wait(lambda: False)
+      size = upload.written - self.position
+    else:
+      self._wait(lambda: upload.written > self.position)
+    # A short read is fine, only an empty one means the end of the file.
+    size = max(0, min(size, upload.written - self.position))
+    data = os.pread(upload.file.fileno(), size, self.position)
+    self.position += len(data)
+    return data
+
+  def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+    if whence == os.SEEK_END:
+      self._wait(lambda: False)
+      self.position = self.upload.written + offset
+    elif whence == os.SEEK_CUR:
+      self.position += offset
+    else:
+      self.position = offset
+    return self.position
+
+  def tell(self) -> int:
+    return self.position
+
+
+class Upload:
+  """An uploaded audio file, spooled to disk as it arrives and decoded at the
+  same time, so neither the upload nor its decode has to be held in memory
+  and decoding is mostly done by the time the last byte arrives."""
+
+  file: BinaryIO
+  written: int
+  finished: bool
+  aborted: bool
+
+  def __init__(self, *, limit: int = UPLOAD_MAX_BYTES) -> None:
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    self.file = tempfile.NamedTemporaryFile(dir=SPOOL_DIR, suffix=".src")
+    self.limit = limit
+    self.written = 0
+    self.finished = False
+    self.aborted = False
+    self.changed = threading.Condition()
+    self._digest = hashlib.blake2b(digest_size=32)
+    self._finished_at: float | None = None
+    self._ended = asyncio.Event()
+    self._decoding: asyncio.Future | None = None
+
+  @property
+  def digest(self) -> str:
+    "Digest of the whole upload, for the caches. Only valid once finished."
+    return self._digest.hexdigest()
+
+  def write(self, chunk: bytes) -> None:
+    if self.written + len(chunk) > self.limit:
+      raise UploadTooLargeError("upload too large")
+    self._digest.update(chunk)
+    # Goes to the page cache, so this doesn't block the event loop for long.
+    view = memoryview(chunk)
+    while view:
+      view = view[os.write(self.file.fileno(), view) :]
+    with self.changed:
+      self.written += len(chunk)
+      self.changed.notify_all()
+
+  def finish(self) -> None:
+    self._finished_at = time.perf_counter()
+    with self.changed:
+      self.finished = True
+      self.changed.notify_all()
+    self._ended.set()
+
+  def abort(self) -> None:
+    "Stop decoding, for when the upload failed or its audio is not needed."
+    with self.changed:
+      self.aborted = True
+      self.changed.notify_all()
+    self._ended.set()
+
+  async def receive(
+    self, chunks: AsyncIterator[bytes], *, decode: bool = True
+  ) -> None:
+    """Spool `chunks` while decoding them, until they run out. Without
+    `decode` they are only spooled, for read() to pick up."""
+    if decode:
+      loop = asyncio.get_running_loop()
+      self._decoding = loop.create_task(self._decode())
+      # Aborted decodes are expected, so don't warn about unretrieved errors.
+      self._decoding.add_done_callback(
+        lambda task: task.cancelled() or task.exception()
+      )
+    try:
+      async for chunk in chunks:
+        self.write(chunk)
+    except BaseException:
+      self.abort()
+      raise
+    self.finish()
+
+  def read(self) -> bytes:
+    "The whole upload as it arrived, once finished. Blocks on the disk."
+    with open(self.file.name, "rb") as f:
+      return f.read()
+
+  async def audio(self) -> numpy.ndarray:
+    "The decoded audio, once the whole upload has arrived and been decoded."
+    return await asyncio.shield(self._decoding)
+
+  async def _decode(self) -> numpy.ndarray:
+    loop = asyncio.get_running_loop()
+    try:
+      try:
+        audio = await loop.run_in_executor(
+          upload_pool, _decode_pyav, _SpoolReader(self)
+        )
+      except (av.error.FFmpegError, ValueError):
+        if self.aborted:
+          raise UploadAbortedError("upload aborted")
+        LOG.warning("In-process decode failed, falling back to ffmpeg")
+        audio = await self._decode_ffmpeg()
+      # Only the decoding left once the upload finished is on the request's
+      # critical path, so that is what gets measured.
+      if self._finished_at is not None:
+        DECODE_SECONDS.observe(time.perf_counter() - self._finished_at)
+      return audio
+    finally:
+      self.file.close()
+
+  async def _decode_ffmpeg(self) -> numpy.ndarray:
+    loop = asyncio.get_running_loop()
+    await self._ended.wait()
+    if self.aborted:
+      raise UploadAbortedError("upload aborted")
+    file_path = await _ffmpeg_to_wav(self.file.name)
+    try:
+      return await loop.run_in_executor(decode_pool, _read_wav, file_path)
+    finally:
+      await aiofiles.os.remove(file_path)
+
+
+class BatchTooLargeError(ValueError):
+  pass
+
+
+def unpack_archive(
+  data: bytes, *, is_zip: bool = False
+) -> list[tuple[str, bytes]]:
+  """The regular files in a tar (optionally compressed) or zip archive, as
+  (name, contents) in archive order. Sizes are checked against the batch
+  limits before anything is extracted."""
+  files = []
+  total = 0
+  try:
+    if is_zip:
+      with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        for info in members:
+          total += info.file_size
+          if len(files) >= BATCH_MAX_FILES or total > BATCH_MAX_BYTES:
+            raise BatchTooLargeError("batch is too large")
+          files.append((info.filename, archive.read(info)))
+      return files
+
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as archive:
+      for member in archive:
+        if not member.isfile():
+          continue
+        total += member.size
+        if len(files) >= BATCH_MAX_FILES or total > BATCH_MAX_BYTES:
+          raise BatchTooLargeError("batch is too large")
+        files.append((member.name, archive.extractfile(member).read()))
+    return files
+  except (tarfile.TarError, zipfile.BadZipFile) as e:
+    raise ValueError(f"could not read the archive: {e}") from None
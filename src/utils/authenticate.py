@@ -3,17 +3,31 @@ from __future__ import annotations
 
 import hashlib
 import json
-import time
+import tomllib
 from enum import Enum
 from typing import TYPE_CHECKING
 
 from aiohttp.web import Response
 
+from utils.cache import LRUCache, SingleFlight
+
 if TYPE_CHECKING:
   from aiohttp import ClientSession
 
   from .extra_request import Application, Request
 
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+
+# The auth server can be swapped for a local stand-in in tests and benchmarks.
+AUTH_URL = config.get("auth", {}).get("url", "https://auth.skystuff.cc")
+AUTH_URL = AUTH_URL.rstrip("/")
+CACHE_ENTRIES = config.get("auth", {}).get("cache_entries", 10000)
+CACHE_TTL = config.get("auth", {}).get("cache_ttl_s", 600)
+# Invalid tokens are remembered briefly, so a client retrying a bad token
+# doesn't cost an auth server round trip every time.
+NEGATIVE_TTL = config.get("auth", {}).get("negative_ttl_s", 30)
+
 
 class Approval(Enum):
   DEFAULT = 0
@@ -85,82 +99,106 @@ class Project:
     self.description = description
 
 
-# Hashed auth token -> user, expiry
-auth_cache: dict[str, tuple[User, int]] = {}
+# Hashed auth token -> user or key, or INVALID
+auth_cache = LRUCache(CACHE_ENTRIES, ttl=CACHE_TTL)
+auth_inflight = SingleFlight()
+INVALID = object()
 
 
-# All this does is authenticate a user existing.
-async def authenticate(
-  request: Request, *, cs: ClientSession = None, use_cache=True
-) -> User | Response | Key:
-  app: Application = request.app
-  if cs is None:
-    cs = app.cs
+def _token_hash(auth_token: str) -> str:
+  return hashlib.blake2b(auth_token.encode(), digest_size=32).hexdigest()
 
-  # We prioritize header authentication over cookie authentication.
-  auth_token = request.cookies.get("Authorization", None)
-  auth_token = request.headers.get("Authorization", auth_token)
 
-  if auth_token is None:
-    return Response(
-      status=401, body="pass Authorization header or Authorization cookie."
-    )
-
-  auth_token = auth_token.removeprefix("Bearer ")
-
-  # Get the hash of it for cache checking
-  if use_cache:
-    token_hash = hashlib.sha512(auth_token.encode()).hexdigest()
-    if token_hash in auth_cache:
-      details = auth_cache[token_hash]
-      current_time = time.time()
-      if current_time < details[1]:
-        return details[0]
-
-  # Now we want to send the request
+async def _lookup(auth_token: str, cs: ClientSession) -> User | Key | None:
+  "Ask the auth server who a token belongs to. None if it is invalid."
   # Removing and adding Bearer is mildly redundant
   headers = {"Authorization": f"Bearer {auth_token}"}
 
-  async with cs.get(
-    "https://auth.skystuff.cc/api/user/get/", headers=headers
-  ) as resp:
+  async with cs.get(f"{AUTH_URL}/api/user/get/", headers=headers) as resp:
     if resp.status == 200:
       data = json.loads(await resp.text())
-      u = User(
+      return User(
         username=data["name"],
         super_admin=data["super_admin"],
         email=data["email"],
         token=data["token"],
       )
-
-      token_hash = hashlib.sha512(auth_token.encode()).hexdigest()
-      current_time = time.time()
-      auth_cache[token_hash] = (u, current_time + 600)
-
-      return u
     elif resp.status == 400:
       text = await resp.text()
       if not text.startswith("please use /key/"):
-        return Response(status=401, body="invalid token")
-      async with cs.get(
-        "https://auth.skystuff.cc/api/key/" + auth_token
-      ) as kresp:
+        return None
+      async with cs.get(f"{AUTH_URL}/api/key/{auth_token}") as kresp:
         if kresp.status != 200:
-          return Response(status=401, body="invalid token")
+          return None
         data = json.loads(await kresp.text())
         project = Project(**data["project"])
         user = User(**data["user"])
-        key = Key(
+        return Key(
           name=data["name"],
           id=data["id"],
           data=data["data"],
           user=user,
           project=project,
         )
-        return key
+    elif resp.status >= 500:
+      # Not the token's fault, so don't remember it as invalid.
+      raise ConnectionError(f"auth server returned {resp.status}")
+    else:
+      return None
+
+
+async def _cached_lookup(
+  auth_token: str, cs: ClientSession
+) -> User | Key | None:
+  token_hash = _token_hash(auth_token)
+  cached = auth_cache.get(token_hash)
+  if cached is INVALID:
+    return None
+  if cached is not None:
+    return cached
+
+  async def run() -> User | Key | None:
+    result = await _lookup(auth_token, cs)
+    if result is None:
+      auth_cache.set(token_hash, INVALID, ttl=NEGATIVE_TTL)
+    else:
+      auth_cache.set(token_hash, result)
+    return result
+
+  # Concurrent requests with the same token share one lookup.
+  return await auth_inflight.run(token_hash, run)
+
+
+# All this does is authenticate a user existing.
+async def authenticate(
+  request: Request, *, cs: ClientSession = None, use_cache=True
+) -> User | Response | Key:
+  app: Application = request.app
+  if cs is None:
+    cs = app.cs
 
+  # We prioritize header authentication over cookie authentication.
+  auth_token = request.cookies.get("Authorization", None)
+  auth_token = request.headers.get("Authorization", auth_token)
+
+  if auth_token is None:
+    return Response(
+      status=401, body="pass Authorization header or Authorization cookie."
+    )
+
+  auth_token = auth_token.removeprefix("Bearer ")
+
+  try:
+    if use_cache:
+      result = await _cached_lookup(auth_token, cs)
     else:
-      return Response(status=401, body="invalid token")
+      result = await _lookup(auth_token, cs)
+  except ConnectionError:
+    return Response(status=401, body="invalid token")
+
+  if result is None:
+    return Response(status=401, body="invalid token")
+  return result
 
 
 async def get_project_status(
@@ -168,7 +206,7 @@ async def get_project_status(
 ) -> Approval | False:
   headers = {"Authorization": f"Bearer {user.token}"}
   async with cs.get(
-    f"https://auth.skystuff.cc/api/project/status/{project_name}",
+    f"{AUTH_URL}/api/project/status/{project_name}",
     headers=headers,
   ) as resp:
     if resp.status != 200:
@@ -0,0 +1,214 @@
+# Bounded caches and request coalescing
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from typing import Any, Awaitable, Callable, Hashable
+
+  from asyncpg import Pool
+
+LOG = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache:
+  """A dict that forgets its least recently used entries once the total size
+  of what it holds goes over `max_size`, and optionally expires entries after
+  `ttl` seconds. By default every entry has a size of 1."""
+
+  max_size: int
+  ttl: float | None
+  size: int
+
+  def __init__(
+    self,
+    max_size: int,
+    *,
+    ttl: float = None,
+    sizeof: Callable[[Any], int] = None,
+  ) -> None:
+    self.max_size = max_size
+    self.ttl = ttl
+    self.sizeof = sizeof or (lambda _: 1)
+    self.size = 0
+    # key -> (value, size, expiry)
+    self._data: OrderedDict[Hashable, tuple[Any, int, float]] = OrderedDict()
+
+  def __len__(self) -> int:
+    return len(self._data)
+
+  def __contains__(self, key: Hashable) -> bool:
+    return self.get(key, _MISSING) is not _MISSING
+
+  def get(self, key: Hashable, default: Any = None) -> Any:
+    entry = self._data.get(key)
+    if entry is None:
+      return default
+    value, _, expiry = entry
+    if expiry < time.monotonic():
+      self.pop(key)
+      return default
+    self._data.move_to_end(key)
+    return value
+
+  def set(
+    self, key: Hashable, value: Any, *, ttl: float = None, size: int = None
+  ) -> None:
+    "Store `value`, with `size` in place of sizeof(value) when it's known."
+    self.pop(key)
+    size = size if size is not None else self.sizeof(value)
+    if size > self.max_size:
+      return
+    ttl = ttl if ttl is not None else self.ttl
+    expiry = time.monotonic() + ttl if ttl is not None else float("inf")
+    self._data[key] = (value, size, expiry)
+    self.size += size
+    while self.size > self.max_size:
+      _, (_, evicted_size, _) = self._data.popitem(last=False)
+      self.size -= evicted_size
+
+  def pop(self, key: Hashable, default: Any = None) -> Any:
+    entry = self._data.pop(key, None)
+    if entry is None:
+      return default
+    self.size -= entry[1]
+    return entry[0]
+
+  def clear(self) -> None:
+    self._data.clear()
+    self.size = 0
+
+
+class SingleFlight:
+  "Share one running call between every caller asking for the same key."
+
+  def __init__(self) -> None:
+    self._inflight: dict[Hashable, asyncio.Future] = {}
+
+  def __len__(self) -> int:
+    return len(self._inflight)
+
+  async def run(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+    future = self._inflight.get(key)
+    if future is None:
+      future = asyncio.ensure_future(func())
+      self._inflight[key] = future
+      future.add_done_callback(lambda _: self._inflight.pop(key, None))
+    # Shielded so one caller disconnecting doesn't cancel the others' work.
+    return await asyncio.shield(future)
+
+
+class ResultCache:
+  """Memory LRU in front of an optional Postgres table, with concurrent
+  requests for the same key sharing a single computation. Values go in the
+  table as `encode` makes them, and come back out through `decode`, which
+  raises ValueError for data it doesn't recognise. The memory tier holds up
+  to `max_bytes` of values, counted by their encoded size. Rows in the
+  table expire `expire_after` seconds after they were written, and are
+  swept out every `sweep_interval` seconds."""
+
+  TABLE = "transcription_cache"
+
+  memory: LRUCache
+  pool: Pool | None
+  expire_after: float
+  sweep_interval: float
+
+  def __init__(
+    self,
+    max_bytes: int,
+    *,
+    encode: Callable[[Any], bytes],
+    decode: Callable[[bytes], Any],
+    expire_after: float,
+    sweep_interval: float = 3600,
+  ) -> None:
+    self.memory = LRUCache(max_bytes, sizeof=lambda value: len(encode(value)))
+    self.encode = encode
+    self.decode = decode
+    self.pool = None
+    self.expire_after = expire_after
+    self.sweep_interval = sweep_interval
+    self.inflight = SingleFlight()
+    self._sweeper: asyncio.Task | None = None
+
+  async def attach(self, pool: Pool) -> None:
+    "Use `pool` as a second, persistent tier."
+    async with pool.acquire() as conn:
+      await conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS {self.TABLE} (
+          key TEXT PRIMARY KEY,
+          result BYTEA NOT NULL,
+          created TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS {self.TABLE}_created
+          ON {self.TABLE} (created);"""
+      )
+    self.pool = pool
+    self._sweeper = asyncio.get_running_loop().create_task(self._sweep())
+
+  async def _sweep(self) -> None:
+    "Delete expired rows now and then, so the table doesn't grow forever."
+    while True:
+      try:
+        await self.pool.execute(
+          f"""DELETE FROM {self.TABLE}
+          WHERE created < now() - $1::float8 * interval '1 second';""",
+          float(self.expire_after),
+        )
+      except Exception:
+        LOG.exception("Failed sweeping the result cache table")
+      await asyncio.sleep(self.sweep_interval)
+
+  async def get_or_run(
+    self, key: str, func: Callable[[], Awaitable[Any]]
+  ) -> Any:
+    value = self.memory.get(key, _MISSING)
+    if value is not _MISSING:
+      return value
+    return await self.inflight.run(key, lambda: self._load(key, func))
+
+  async def _load(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+    if self.pool is not None:
+      try:
+        data = await self.pool.fetchval(
+          f"""SELECT result FROM {self.TABLE} WHERE key = $1
+          AND created >= now() - $2::float8 * interval '1 second';""",
+          key,
+          float(self.expire_after),
+        )
+        if data is not None:
+          value = self.decode(data)
+          self.memory.set(key, value, size=len(data))
+          return value
+      except Exception:
+        # Including rows that don't decode, which put() then replaces.
+        LOG.exception("Failed reading from the result cache table")
+
+    value = await func()
+    await self.put(key, value)
+    return value
+
+  async def put(self, key: str, value: Any) -> None:
+    # Encoded once, for both its size in memory and the table.
+    data = self.encode(value)
+    self.memory.set(key, value, size=len(data))
+    if self.pool is None:
+      return
+    try:
+      # Only ever called after a miss, so any row already there is expired
+      # or unreadable, and is written over.
+      await self.pool.execute(
+        f"""INSERT INTO {self.TABLE} (key, result) VALUES ($1, $2)
+        ON CONFLICT (key) DO UPDATE SET result = $2, created = now();""",
+        key,
+        data,
+      )
+    except Exception:
+      LOG.exception("Failed writing to the result cache table")
@@ -0,0 +1,197 @@
+# Turn transcription results into the response formats clients can ask for
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import msgpack
+import orjson
+
+if TYPE_CHECKING:
+  from collections.abc import Iterator
+
+  from faster_whisper.transcribe import Segment, Word
+
+  from utils.whisper import TranscriptionResult
+
+# output= value -> content type
+FORMATS = {
+  "text": "text/plain; charset=utf-8",
+  "json": "application/json",
+  "columnar": "application/json",
+  "msgpack": "application/msgpack",
+  "srt": "application/x-subrip; charset=utf-8",
+  "vtt": "text/vtt; charset=utf-8",
+}
+
+
+def dumps(packet: dict) -> bytes:
+  """JSON encode with orjson, which is several times faster than json. Any
+  numpy values that get through are encoded too, rather than raising."""
+  return orjson.dumps(packet, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def segment_packet(segment: Segment) -> dict:
+  words = [
+    {
+      "start": word.start,
+      "end": word.end,
+      "word": word.word,
+      "probability": word.probability,
+    }
+    for word in segment.words or ()
+  ]
+  return {
+    "start": segment.start,
+    "end": segment.end,
+    "text": segment.text.strip(),
+    "words": words,
+  }
+
+
+def _summary(result: TranscriptionResult) -> dict:
+  return {
+    "full_text": result.full_text,
+    "language": result.language,
+    "language_probability": result.language_prob,
+    "duration": result.info.duration,
+  }
+
+
+def result_packet(result: TranscriptionResult) -> dict:
+  "One object per segment, and per word, as the API has always returned."
+  packet = _summary(result)
+  packet["segments"] = [segment_packet(segment) for segment in result.segments]
+  return packet
+
+
+def columnar_packet(result: TranscriptionResult) -> dict:
+  """Segments and words as parallel arrays, which skips building an object
+  for each of them and repeating every key in the output. Each word's entry
+  in "segment" is the index of the segment it belongs to."""
+  segments = result.segments
+  words = [
+    (idx, word)
+    for idx, segment in enumerate(segments)
+    for word in segment.words or ()
+  ]
+  packet = _summary(result)
+  packet["segments"] = {
+    "start": [segment.start for segment in segments],
+    "end": [segment.end for segment in segments],
+    "text": [segment.text.strip() for segment in segments],
+  }
+  packet["words"] = {
+    "segment": [idx for idx, _ in words],
+    "start": [word.start for _, word in words],
+    "end": [word.end for _, word in words],
+    "word": [word.word for _, word in words],
+    "probability": [word.probability for _, word in words],
+  }
+  return packet
+
+
+def _timestamp(seconds: float, separator: str) -> str:
+  millis = round(seconds * 1000)
+  hours, millis = divmod(millis, 3_600_000)
+  minutes, millis = divmod(millis, 60_000)
+  seconds, millis = divmod(millis, 1000)
+  return f"{hours:02}:{minutes:02}:{seconds:02}{separator}{millis:03}"
+
+
+# Longest a subtitle cue may run, in characters and seconds, before segments
+# with word timings are split into several.
+CUE_MAX_CHARS = 84
+CUE_MAX_S = 7.0
+
+
+def _cue(words: list[Word]) -> tuple[float, float, str]:
+  return words[0].start, words[-1].end, "".join(w.word for w in words).strip()
+
+
+def _cues(result: TranscriptionResult) -> Iterator[tuple[float, float, str]]:
+  """(start, end, text) for each subtitle cue. Segments with word timings
+  are split between words to keep each cue short enough to read, the rest
+  are one cue each."""
+  for segment in result.segments:
+    if not segment.words:
+      yield segment.start, segment.end, segment.text.strip()
+      continue
+    words = []
+    length = 0
+    for word in segment.words:
+      if words and (
+        length + len(word.word) > CUE_MAX_CHARS
+        or word.end - words[0].start > CUE_MAX_S
+      ):
+        yield _cue(words)
+        words = []
+        length = 0
+      words.append(word)
+      length += len(word.word)
+    yield _cue(words)
+
+
+def srt(result: TranscriptionResult) -> str:
+  cues = [
+    f"{idx}\n{_timestamp(start, ',')} --> {_timestamp(end, ',')}\n{text}\n"
+    for idx, (start, end, text) in enumerate(_cues(result), 1)
+  ]
+  return "\n".join(cues)
+
+
+def vtt(result: TranscriptionResult) -> str:
+  cues = [
+    f"{_timestamp(start, '.')} --> {_timestamp(end, '.')}\n{text}\n"
+    for start, end, text in _cues(result)
+  ]
+  return "\n".join(["WEBVTT\n"] + cues)
+
+
+def render(result: TranscriptionResult, fmt: str, **fields) -> bytes:
+  """The body for `result` in one of FORMATS. `fields` are added to the top
+  level of the formats that have one."""
+  if fmt == "text":
+    return result.full_text.encode()
+  if fmt == "json":
+    return dumps({**result_packet(result), **fields})
+  if fmt == "columnar":
+    return dumps({**columnar_packet(result), **fields})
+  if fmt == "msgpack":
+    # 32 bit floats take half the space, and keep timestamps to within a
+    # millisecond for the first couple of hours.
+    return msgpack.packb(
+      {**columnar_packet(result), **fields}, use_single_float=True
+    )
+  if fmt == "srt":
+    return srt(result).encode()
+  if fmt == "vtt":
+    return vtt(result).encode()
+  raise ValueError(f"output must be one of {', '.join(FORMATS)}")
+
+
+def _file_packet(result: TranscriptionResult, fmt: str) -> dict:
+  if fmt == "json":
+    return result_packet(result)
+  if fmt in ("columnar", "msgpack"):
+    return columnar_packet(result)
+  if fmt == "srt":
+    return {"srt": srt(result)}
+  if fmt == "vtt":
+    return {"vtt": vtt(result)}
+  return {"full_text": result.full_text}
+
+
+def render_batch(
+  files: list[tuple[str, TranscriptionResult | Exception]], fmt: str, **fields
+) -> bytes:
+  """The body for a batch, with one entry per file in order: its name and
+  either its result in `fmt`, or the error that stopped it."""
+  packet = {**fields, "files": []}
+  for name, result in files:
+    if isinstance(result, Exception):
+      packet["files"].append({"name": name, "error": repr(result)})
+    else:
+      packet["files"].append({"name": name, **_file_packet(result, fmt)})
+  if fmt == "msgpack":
+    return msgpack.packb(packet, use_single_float=True)
+  return dumps(packet)
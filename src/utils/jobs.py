@@ -0,0 +1,209 @@
+# Postgres-backed queue of asynchronous transcription jobs
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import tomllib
+import uuid
+from typing import TYPE_CHECKING
+
+from utils.whisper import TranscriptionResult, transcribe_bytes, transcribe_file
+
+if TYPE_CHECKING:
+  from asyncpg import Pool, Record
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+
+CONSUMERS = config.get("jobs", {}).get("consumers", 2)
+POLL_INTERVAL = config.get("jobs", {}).get("poll_interval_s", 2.0)
+# A running job's consumer renews its heartbeat this often. One that hasn't
+# for stale_after_s is assumed to belong to a dead instance and is retried,
+# up to max_attempts runs in all, after which it is marked failed.
+HEARTBEAT = config.get("jobs", {}).get("heartbeat_s", 30)
+STALE_AFTER = config.get("jobs", {}).get("stale_after_s", 120)
+MAX_ATTEMPTS = config.get("jobs", {}).get("max_attempts", 3)
+# Largest upload a job takes. Its audio is stored in the table until it has
+# run, and bytea can't hold more than 1 GB.
+MAX_BYTES = config.get("jobs", {}).get("max_mb", 1024) * 1024**2
+
+LOG = logging.getLogger(__name__)
+
+TABLE = "transcription_jobs"
+
+
+class JobQueue:
+  """Jobs are rows in Postgres, so they survive restarts and any number of
+  service instances can consume the same queue."""
+
+  pool: Pool | None
+
+  def __init__(self) -> None:
+    self.pool = None
+    self._wakeup = asyncio.Event()
+    self._consumers: list[asyncio.Task] = []
+
+  async def start(self, pool: Pool, *, consumers: int = CONSUMERS) -> None:
+    async with pool.acquire() as conn:
+      await conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS {TABLE} (
+          id UUID PRIMARY KEY,
+          status TEXT NOT NULL DEFAULT 'queued',
+          source TEXT NOT NULL,
+          options TEXT NOT NULL,
+          audio BYTEA,
+          result BYTEA,
+          error TEXT,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          created TIMESTAMPTZ NOT NULL DEFAULT now(),
+          started TIMESTAMPTZ,
+          heartbeat TIMESTAMPTZ,
+          finished TIMESTAMPTZ
+        );
+        ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS heartbeat TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS {TABLE}_queued
+          ON {TABLE} (created) WHERE status IN ('queued', 'running');"""
+      )
+    self.pool = pool
+    loop = asyncio.get_running_loop()
+    for _ in range(consumers):
+      self._consumers.append(loop.create_task(self._consume()))
+
+  async def submit(self, source: str, audio: bytes, options: dict) -> str:
+    "Store a job and return its id. `source` is either 'file' or 'raw'."
+    job_id = uuid.uuid4()
+    await self.pool.execute(
+      f"""INSERT INTO {TABLE} (id, source, options, audio)
+      VALUES ($1, $2, $3, $4);""",
+      job_id,
+      source,
+      json.dumps(options),
+      audio,
+    )
+    self._wakeup.set()
+    return str(job_id)
+
+  async def status(self, job_id: str) -> Record | None:
+    return await self.pool.fetchrow(
+      f"""SELECT id, status, error, attempts, created, started, finished
+      FROM {TABLE} WHERE id = $1;""",
+      uuid.UUID(job_id),
+    )
+
+  async def result(self, job_id: str) -> TranscriptionResult | None:
+    job_id = uuid.UUID(job_id)
+    data = await self.pool.fetchval(
+      f"SELECT result FROM {TABLE} WHERE id = $1 AND status = 'done';",
+      job_id,
+    )
+    if data is None:
+      return None
+    try:
+      return TranscriptionResult.from_json(data)
+    except ValueError:
+      # Such as a result stored by an older version.
+      LOG.exception(f"Failed reading the result of job {job_id}!")
+      await self.pool.execute(
+        f"""UPDATE {TABLE} SET status = 'failed', result = NULL,
+        error = 'stored result could not be read' WHERE id = $1;""",
+        job_id,
+      )
+      return None
+
+  async def _claim(self) -> Record | None:
+    async with self.pool.acquire() as conn, conn.transaction():
+      # Jobs whose consumer died on the last attempt they were allowed.
+      await conn.execute(
+        f"""UPDATE {TABLE}
+        SET status = 'failed', finished = now(), audio = NULL,
+          error = 'gave up after ' || attempts || ' attempts'
+        WHERE status = 'running' AND attempts >= $2
+          AND coalesce(heartbeat, started)
+            < now() - $1::float8 * interval '1 second';""",
+        float(STALE_AFTER),
+        MAX_ATTEMPTS,
+      )
+      return await conn.fetchrow(
+        f"""UPDATE {TABLE}
+        SET status = 'running', started = now(), heartbeat = now(),
+          attempts = attempts + 1
+        WHERE id = (
+          SELECT id FROM {TABLE}
+          WHERE status = 'queued'
+            OR (status = 'running' AND attempts < $2
+              AND coalesce(heartbeat, started)
+                < now() - $1::float8 * interval '1 second')
+          ORDER BY created
+          FOR UPDATE SKIP LOCKED
+          LIMIT 1
+        )
+        RETURNING id, source, options, audio;""",
+        float(STALE_AFTER),
+        MAX_ATTEMPTS,
+      )
+
+  async def _beat(self, job_id: uuid.UUID) -> None:
+    "Keep renewing a running job's heartbeat, so no one else reclaims it."
+    while True:
+      await asyncio.sleep(HEARTBEAT)
+      try:
+        await self.pool.execute(
+          f"""UPDATE {TABLE} SET heartbeat = now()
+          WHERE id = $1 AND status = 'running';""",
+          job_id,
+        )
+      except Exception:
+        LOG.exception(f"Failed renewing the heartbeat of job {job_id}!")
+
+  async def _run(self, job: Record) -> None:
+    options = json.loads(job["options"])
+    heartbeat = asyncio.get_running_loop().create_task(self._beat(job["id"]))
+    try:
+      if job["source"] == "raw":
+        result = await transcribe_bytes(job["audio"], **options)
+      else:
+        result = await transcribe_file(job["audio"], **options)
+    except Exception as e:
+      LOG.exception(f"Job {job['id']} failed!")
+      await self.pool.execute(
+        f"""UPDATE {TABLE} SET status = 'failed', error = $2,
+        finished = now(), audio = NULL WHERE id = $1;""",
+        job["id"],
+        repr(e),
+      )
+      return
+    finally:
+      heartbeat.cancel()
+
+    await self.pool.execute(
+      f"""UPDATE {TABLE} SET status = 'done', result = $2,
+      finished = now(), audio = NULL WHERE id = $1;""",
+      job["id"],
+      result.to_json(),
+    )
+
+  async def _consume(self) -> None:
+    while True:
+      # Cleared before claiming, so a submit during the claim isn't missed.
+      self._wakeup.clear()
+      try:
+        job = await self._claim()
+      except Exception:
+        LOG.exception("Failed claiming a job!")
+        job = None
+
+      if job is None:
+        try:
+          await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+          pass
+        continue
+
+      try:
+        await self._run(job)
+      except Exception:
+        LOG.exception(f"Failed storing the outcome of job {job['id']}!")
+
+
+job_queue = JobQueue()
@@ -1,8 +1,10 @@
 # Ratelimiter
 from __future__ import annotations
 
+import asyncio
 import functools
-import hashlib
+import itertools
+import math
 import re
 import time
 from ipaddress import ip_address, ip_network
@@ -11,13 +13,77 @@ from typing import TYPE_CHECKING
 from aiohttp.web import Response
 
 from utils.authenticate import authenticate
+from utils.limiter_stores import PostgresStore
 from utils.logger import get_origin_ip
 
 if TYPE_CHECKING:
   from ipaddress import IPv4Address
   from typing import Awaitable, Callable
 
+  from asyncpg import Pool
+
   from utils.extra_request import Request
+  from utils.limiter_stores import SharedMemoryStore
+
+# Seconds between sweeps of clients whose limits have fully recovered.
+SWEEP_INTERVAL = 60
+# Clients evicted per sweep step before yielding to the event loop.
+SWEEP_STEP = 10000
+
+
+class Rate:
+  """`total` requests per `seconds` for every client, enforced with GCRA: each
+  client is a single "theoretical arrival time", which moves `interval`
+  seconds into the future per request, and a request is refused while that
+  lies more than `tolerance` seconds ahead. That allows bursts of `total`
+  requests, refilled at an even rate, in constant time and memory per client.
+  """
+
+  name: str
+  total: int
+  seconds: int
+  interval: float
+  tolerance: float
+  # client -> theoretical arrival time, ordered by when it last made a request
+  clients: dict[str, float]
+
+  def __init__(self, name: str, total: int, seconds: int) -> None:
+    self.name = name
+    self.total = total
+    self.seconds = seconds
+    self.interval = seconds / total
+    self.tolerance = seconds - self.interval
+    self.clients = {}
+
+  def acquire(self, client: str, now: float) -> float:
+    "Take one request for `client`. Returns 0, or seconds until one is free."
+    tat = self.clients.get(client, now)
+    if tat < now:
+      tat = now
+    wait = tat - now - self.tolerance
+    if wait > 0:
+      return wait
+    # Re-inserted so the dict stays in order of last use, for sweep().
+    self.clients.pop(client, None)
+    self.clients[client] = tat + self.interval
+    return 0
+
+  def sweep(self, now: float, limit: int) -> int:
+    """Forget up to `limit` clients that have fully recovered, which is the
+    same as never having seen them. Returns how many were forgotten.
+
+    Clients are in order of last use and nobody stays ahead of `now` for
+    longer than `seconds` after their last request, so stopping at the first
+    one still recovering leaves only clients active within that window."""
+    evicted = 0
+    for tat in self.clients.values():
+      if tat > now or evicted >= limit:
+        break
+      evicted += 1
+    for client in list(itertools.islice(self.clients, evicted)):
+      del self.clients[client]
+    return evicted
+
 
 # Ideal usecase:
 # limiter = Limiter(use_auth = True, use_auth_cache = True, exempt_ips=[])
@@ -28,7 +94,8 @@ if TYPE_CHECKING:
 
 
 class Limiter:
-  current_limits: dict[str, dict[str, list[int]]]
+  rates: dict[tuple[str, str], Rate]
+  store: PostgresStore | SharedMemoryStore | None
   EXPR: re.Pattern
   use_auth: bool
   use_auth_cache: bool
@@ -40,8 +107,11 @@ class Limiter:
     use_auth: bool = True,
     use_auth_cache: bool = True,
     exempt_ips: list[str],
+    store: PostgresStore | SharedMemoryStore = None,
   ) -> None:
     self.use_auth = use_auth
+    # Where limits are counted. By default each process counts on its own.
+    self.store = store
     self.use_auth_cache = use_auth_cache
     self.exempt_ips = []
     for ip in exempt_ips:
@@ -66,14 +136,19 @@ class Limiter:
       ),
       re.IGNORECASE | re.VERBOSE,
     )
-    # {
-    #   "route_name": {
-    #     "hashed_user_identifier": [
-    #       timestamp_when_free
-    #     ]
-    #   }
-    # }
-    self.current_limits: dict[str, dict[str, list[int]]] = {}
+    # (route name, limit string) -> Rate
+    self.rates = {}
+    self._sweeper: asyncio.Task | None = None
+
+  async def attach(
+    self, pool: Pool, *, lease_divisor: int = 10, min_lease: int = 3
+  ) -> None:
+    "Count limits in Postgres, so they hold across every replica."
+    store = PostgresStore(
+      pool, lease_divisor=lease_divisor, min_lease=min_lease
+    )
+    await store.create()
+    self.store = store
 
   def is_exempt(self, ipaddr: str) -> bool:
     ip = ip_address(ipaddr)
@@ -95,32 +170,22 @@ class Limiter:
     route_name: str = None,
     force_auth: bool = False,
   ) -> Callable[[Request, None], Awaitable[Response]]:
-    # Check the limits for validity
-    self.parse_limit(normal_limit)
-    if auth_limit:
-      self.parse_limit(auth_limit)
+    # Parsed once here rather than on every request, which also checks them.
+    if auth_limit is None:
+      auth_limit = normal_limit
 
     def _decorator(
       f: Callable[[Request, None], Awaitable[Response]],
     ) -> Callable[[Request, None], Awaitable[Response]]:
-      @functools.wraps(f)
-      async def _inner(
-        request: Request,
-        *,
-        normal_limit: str = normal_limit,
-        auth_limit: str = auth_limit,
-        force_auth: bool = force_auth,
-        route_name: str = route_name,
-      ) -> Response:
-        if route_name is None:
-          route_name = f.__name__
-        if auth_limit is None:
-          auth_limit = normal_limit
+      name = route_name or f.__name__
+      normal_rate = self.rate(name, normal_limit)
+      auth_rate = self.rate(name, auth_limit)
 
+      @functools.wraps(f)
+      async def _inner(request: Request) -> Response:
         resp = await self._limiter(
-          normal_limit,
-          auth_limit=auth_limit,
-          route_name=route_name,
+          normal_rate,
+          auth_rate=auth_rate,
           force_auth=force_auth,
           request=request,
         )
@@ -134,6 +199,13 @@ class Limiter:
 
     return _decorator
 
+  def rate(self, route_name: str, limit: str) -> Rate:
+    "The shared state for `limit` on `route_name`."
+    key = (route_name, limit)
+    if key not in self.rates:
+      self.rates[key] = Rate(f"{route_name}:{limit}", *self.parse_limit(limit))
+    return self.rates[key]
+
   def parse_limit(self, limit: str) -> tuple[int, int]:
     # Take in a limit string, output [limit, seconds]
     match = self.EXPR.match(limit)
@@ -165,10 +237,9 @@ class Limiter:
 
   async def _limiter(
     self,
-    normal_limit: str,
+    normal_rate: Rate,
     *,
-    auth_limit: str = None,
-    route_name: str,
+    auth_rate: Rate,
     force_auth: bool = False,
     request: Request,
   ) -> Response | None:
@@ -176,10 +247,10 @@ class Limiter:
     if self.is_exempt(ip):
       return None
 
-    if self.use_auth and auth_limit is None:
-      raise Exception("must pass auth limit when use_auth is True!")
+    if self._sweeper is None or self._sweeper.done():
+      self._sweeper = asyncio.get_running_loop().create_task(self._sweep())
 
-    ident = None
+    rate = None
 
     if self.use_auth:
       try:
@@ -190,40 +261,30 @@ class Limiter:
         if not hasattr(user, "username"):
           if force_auth:
             return Response(status=401)
-          else:
-            ident = None
         else:
-          ident = hashlib.sha512(user.username.encode()).hexdigest()
-          resolved_limit = auth_limit
+          ident = f"user:{user.username}"
+          rate = auth_rate
       except Exception:
-        ident = None
-
-    if ident is None:
-      ident = hashlib.sha512(ip.encode()).hexdigest()
-      resolved_limit = normal_limit
-
-    # Now check if the ratelimit is free
-    total, seconds = self.parse_limit(resolved_limit)
-
-    if route_name not in self.current_limits:
-      self.current_limits[route_name] = {}
-    if ident not in self.current_limits[route_name]:
-      self.current_limits[route_name][ident] = []
-
-    user_limits = self.current_limits[route_name][ident]
+        pass
 
-    # Check if any are expired
-    current_time = int(time.time())
-    user_limits = [expiry for expiry in user_limits if current_time < expiry]
-    user_limits.sort()
-    self.current_limits[route_name][ident] = user_limits
+    if rate is None:
+      ident = f"ip:{ip}"
+      rate = normal_rate
 
-    if len(user_limits) >= total:
-      # calculate next free
-      current_time = int(time.time())
-      time_until_free = user_limits[0] - current_time
-      return Response(status=429, headers={"Retry-After": str(time_until_free)})
+    if self.store is None:
+      wait = rate.acquire(ident, time.monotonic())
     else:
-      # add current request to window, return None
-      current_time = int(time.time())
-      user_limits.append(current_time + seconds)
+      wait = await self.store.acquire(rate, ident)
+    if wait > 0:
+      return Response(status=429, headers={"Retry-After": str(math.ceil(wait))})
+    return None
+
+  async def _sweep(self) -> None:
+    "Forget recovered clients now and then, so memory tracks active clients."
+    while True:
+      await asyncio.sleep(SWEEP_INTERVAL)
+      if self.store is not None:
+        await self.store.sweep()
+      for rate in list(self.rates.values()):
+        while rate.sweep(time.monotonic(), SWEEP_STEP) == SWEEP_STEP:
+          await asyncio.sleep(0)
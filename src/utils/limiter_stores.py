@@ -0,0 +1,203 @@
+# Rate limit state shared between server processes and replicas
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import hashlib
+import logging
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING
+
+from utils.cache import LRUCache, SingleFlight
+
+if TYPE_CHECKING:
+  from asyncpg import Pool
+
+  from utils.limiter import Rate
+
+LOG = logging.getLogger(__name__)
+
+# Slots looked at for a client before the shared table counts as full there.
+PROBE_LENGTH = 32
+
+
+def _hash(key: str) -> int:
+  "A 64 bit hash that is the same in every process, unlike hash()."
+  value = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest())
+  return value or 1  # 0 marks an empty slot
+
+
+class SharedMemoryStore:
+  """GCRA state in a shared memory segment, so every server process on a host
+  enforces one limit. The segment is a fixed size open addressing table of
+  (key hash, theoretical arrival time) pairs, guarded by a file lock. Slots
+  of clients that have fully recovered are reused, so it never needs a sweep.
+  """
+
+  def __init__(self, name: str, *, slots: int = 1 << 16) -> None:
+    try:
+      self.memory = SharedMemory(name, create=True, size=slots * 16)
+    except FileExistsError:
+      self.memory = SharedMemory(name)
+    # The segment must outlive whichever process happened to create it.
+    resource_tracker.unregister(self.memory._name, "shared_memory")
+    self.slots = self.memory.size // 16
+    self.hashes = self.memory.buf[: self.slots * 8].cast("Q")
+    self.tats = self.memory.buf[self.slots * 8 : self.slots * 16].cast("d")
+    self.lock = open(f"/tmp/{name}.lock", "a")
+
+  def _acquire(self, key: str, rate: Rate, now: float) -> float:
+    hashed = _hash(key)
+    start = hashed % self.slots
+    slot = None
+    reusable = None
+    for i in range(PROBE_LENGTH):
+      candidate = (start + i) % self.slots
+      stored = self.hashes[candidate]
+      if stored == hashed:
+        slot = candidate
+        break
+      if stored == 0 or self.tats[candidate] <= now:
+        if reusable is None:
+          reusable = candidate
+        if stored == 0:
+          break
+
+    if slot is not None:
+      tat = max(self.tats[slot], now)
+    else:
+      if reusable is None:
+        # Full around here, so drop whoever is closest to recovering.
+        reusable = min(
+          ((start + i) % self.slots for i in range(PROBE_LENGTH)),
+          key=self.tats.__getitem__,
+        )
+      slot = reusable
+      tat = now
+
+    wait = tat - now - rate.tolerance
+    if wait > 0:
+      return wait
+    self.hashes[slot] = hashed
+    self.tats[slot] = tat + rate.interval
+    return 0
+
+  async def acquire(self, rate: Rate, client: str) -> float:
+    # Never block the event loop waiting on another process. The lock is
+    # only held for one lookup, so a short sleep is all it ever takes.
+    while True:
+      try:
+        fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        break
+      except BlockingIOError:
+        await asyncio.sleep(0.001)
+    try:
+      return self._acquire(f"{rate.name}|{client}", rate, time.time())
+    finally:
+      fcntl.flock(self.lock, fcntl.LOCK_UN)
+
+  async def sweep(self) -> None:
+    pass
+
+
+class PostgresStore:
+  """GCRA state in Postgres, shared by every replica using the database.
+
+  To keep database round trips off most requests, each process leases a
+  slice of a client's allowance (1/lease_divisor of the limit, but at least
+  min_lease requests) and spends it locally. A lease unused after one limit
+  window is forfeited, which can only make the limit stricter. Clients that
+  were refused are remembered locally until they may retry. If the database
+  fails, the process falls back to enforcing the limit on its own."""
+
+  TABLE = "rate_limits"
+
+  def __init__(
+    self, pool: Pool, *, lease_divisor: int = 10, min_lease: int = 3
+  ) -> None:
+    self.pool = pool
+    self.lease_divisor = lease_divisor
+    self.min_lease = min_lease
+    # key -> [tokens left, refused until]
+    self.leases = LRUCache(1 << 20)
+    self.inflight = SingleFlight()
+
+  async def create(self) -> None:
+    async with self.pool.acquire() as conn:
+      await conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS {self.TABLE} (
+          key TEXT PRIMARY KEY,
+          tat DOUBLE PRECISION NOT NULL,
+          granted INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS {self.TABLE}_tat ON {self.TABLE} (tat);"""
+      )
+
+  def _take(self, key: str, now: float) -> float | None:
+    "Spend a leased request. 0 when allowed, the wait when refused, or None."
+    lease = self.leases.get(key)
+    if lease is None:
+      return None
+    if lease[0] > 0:
+      lease[0] -= 1
+      return 0
+    if lease[1] > now:
+      return lease[1] - now
+    return None
+
+  async def _lease(self, key: str, rate: Rate) -> None:
+    # Tight limits like 6/m would otherwise lease a single request at a time,
+    # which is a round trip for every one of them.
+    want = min(
+      rate.total, max(self.min_lease, rate.total // self.lease_divisor)
+    )
+    now = time.time()
+    # Grants as many of `want` requests as GCRA allows, all in one statement
+    # so concurrent leases from other replicas are serialized on the row.
+    granted, tat = await self.pool.fetchrow(
+      f"""INSERT INTO {self.TABLE} AS r (key, tat, granted)
+      VALUES ($1, $2 + LEAST($3, FLOOR($4 / $5) + 1) * $5,
+        LEAST($3, FLOOR($4 / $5) + 1))
+      ON CONFLICT (key) DO UPDATE SET
+        granted = GREATEST(0, LEAST($3,
+          FLOOR(($2 + $4 - GREATEST(r.tat, $2)) / $5) + 1)),
+        tat = GREATEST(r.tat, $2) + GREATEST(0, LEAST($3,
+          FLOOR(($2 + $4 - GREATEST(r.tat, $2)) / $5) + 1)) * $5
+      RETURNING granted, tat;""",
+      key,
+      now,
+      want,
+      rate.tolerance,
+      rate.interval,
+    )
+    if granted:
+      self.leases.set(key, [granted, 0.0], ttl=rate.seconds)
+    else:
+      retry = tat - rate.tolerance
+      self.leases.set(key, [0, retry], ttl=retry - now)
+
+  async def acquire(self, rate: Rate, client: str) -> float:
+    key = f"{rate.name}|{client}"
+    wait = self._take(key, time.time())
+    if wait is not None:
+      return wait
+
+    try:
+      await self.inflight.run(key, lambda: self._lease(key, rate))
+    except Exception:
+      LOG.exception("Failed leasing a rate limit, enforcing it locally")
+      return rate.acquire(client, time.monotonic())
+
+    wait = self._take(key, time.time())
+    # Someone else sharing the same lease took the last of it.
+    return wait if wait is not None else rate.interval
+
+  async def sweep(self) -> None:
+    try:
+      await self.pool.execute(
+        f"DELETE FROM {self.TABLE} WHERE tat < $1;", time.time()
+      )
+    except Exception:
+      LOG.exception("Failed sweeping the rate limit table")
@@ -0,0 +1,239 @@
+# Release memory only when the process is actually running short of it
+from __future__ import annotations
+
+import asyncio
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import threading
+import tomllib
+from typing import TYPE_CHECKING
+
+from utils.metrics import Counter, Gauge
+
+if TYPE_CHECKING:
+  from typing import Callable
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+
+
+def _physical_mb() -> float:
+  try:
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**2
+  except (ValueError, OSError):
+    return 0
+
+
+# Thresholds above which the governor steps in. 0 turns a check off. The
+# device check reads the GPUs' memory use through NVML, which comes with the
+# NVIDIA driver, and counts every process on them.
+RSS_LIMIT_MB = config.get("memory", {}).get(
+  "rss_limit_mb", int(_physical_mb() * 0.8)
+)
+DEVICE_LIMIT_MB = config.get("memory", {}).get("device_limit_mb", 0)
+DEVICE_INDEXES = config["model"]["device_idx"]
+if isinstance(DEVICE_INDEXES, int):
+  DEVICE_INDEXES = [DEVICE_INDEXES]
+# Besides whenever the model goes idle, check this often under steady load.
+CHECK_INTERVAL = config.get("memory", {}).get("check_interval_s", 30)
+# Once it has stepped in, the governor waits for usage to fall back under
+# this fraction of the limit before doing so again, unless usage climbs that
+# far again above where it left it.
+REARM_RATIO = config.get("memory", {}).get("rearm_ratio", 0.9)
+
+LOG = logging.getLogger(__name__)
+
+INTERVENTIONS = Counter(
+  "whisper_memory_interventions",
+  "Times the memory governor released memory, by what it released.",
+  ("kind",),
+)
+RSS_BYTES = Gauge(
+  "whisper_resident_memory_bytes",
+  "Resident memory of the server process at the last governor check.",
+)
+DEVICE_BYTES = Gauge(
+  "whisper_device_memory_bytes",
+  "Memory in use on the model's GPUs at the last governor check.",
+)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def rss_bytes() -> int:
+  "Current resident set size, or 0 where /proc isn't available."
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * _PAGE_SIZE
+  except (OSError, ValueError, IndexError):
+    return 0
+
+
+def _load_libc() -> ctypes.CDLL | None:
+  name = ctypes.util.find_library("c")
+  try:
+    libc = ctypes.CDLL(name)
+    libc.malloc_trim
+  except (OSError, AttributeError, TypeError):
+    return None
+  return libc
+
+
+_libc = _load_libc()
+
+
+class _NvmlMemory(ctypes.Structure):
+  _fields_ = [
+    ("total", ctypes.c_ulonglong),
+    ("free", ctypes.c_ulonglong),
+    ("used", ctypes.c_ulonglong),
+  ]
+
+
+def _load_nvml() -> ctypes.CDLL | None:
+  try:
+    nvml = ctypes.CDLL("libnvidia-ml.so.1")
+    if nvml.nvmlInit_v2() != 0:
+      return None
+  except (OSError, AttributeError):
+    return None
+  return nvml
+
+
+_nvml = _load_nvml() if DEVICE_LIMIT_MB > 0 else None
+
+
+def device_bytes() -> int | None:
+  """Memory in use on the model's GPUs, by every process, or None without
+  NVML. NVML numbers devices by PCI bus, as CUDA_DEVICE_ORDER=PCI_BUS_ID
+  makes CUDA do."""
+  if _nvml is None:
+    return None
+  used = 0
+  for index in DEVICE_INDEXES:
+    handle = ctypes.c_void_p()
+    memory = _NvmlMemory()
+    if _nvml.nvmlDeviceGetHandleByIndex_v2(index, ctypes.byref(handle)) != 0:
+      continue
+    if _nvml.nvmlDeviceGetMemoryInfo(handle, ctypes.byref(memory)) != 0:
+      continue
+    used += memory.used
+  return used
+
+
+class MemoryGovernor:
+  """Checked when the model goes idle, and every so often. Over
+  `rss_limit_mb` it runs a full garbage collection, asks anything registered
+  with on_pressure() to drop what it can, and hands freed heap back to the
+  OS. Over `device_limit_mb` it asks anything registered with
+  on_device_pressure() instead. Below both it does nothing, and usage that
+  stays over a limit, as a resident model alone can make it, only gets
+  stepped in on again once it has dropped back or grown further."""
+
+  rss_limit_mb: float
+  device_limit_mb: float
+
+  def __init__(self, *, rss_limit_mb: float, device_limit_mb: float) -> None:
+    self.rss_limit_mb = rss_limit_mb
+    self.device_limit_mb = device_limit_mb
+    self.releases: list[Callable[[], None]] = []
+    self.device_releases: list[Callable[[], None]] = []
+    self._lock = threading.Lock()
+    # kind -> usage the last intervention left, while it is still high.
+    self._settled: dict[str, int] = {}
+
+  async def watch(self, interval: float = CHECK_INTERVAL) -> None:
+    "Check every `interval` seconds, on a thread, until cancelled."
+    loop = asyncio.get_running_loop()
+    while True:
+      await asyncio.sleep(interval)
+      await loop.run_in_executor(None, self.check)
+
+  def on_pressure(self, release: Callable[[], None]) -> None:
+    "Have `release` called to drop caches when memory runs high."
+    self.releases.append(release)
+
+  def on_device_pressure(self, release: Callable[[], None]) -> None:
+    "Have `release` called to free device memory when that runs high."
+    self.device_releases.append(release)
+
+  def check(self) -> None:
+    # Checks from overlapping idle periods would only repeat each other.
+    if not self._lock.acquire(blocking=False):
+      return
+    try:
+      self._check_rss()
+      self._check_device()
+    finally:
+      self._lock.release()
+
+  def _due(self, kind: str, used: int, limit_mb: float) -> bool:
+    "Whether `used` bytes against a limit of `limit_mb` calls for stepping in."
+    limit = limit_mb * 1024**2
+    if used < limit * REARM_RATIO:
+      self._settled.pop(kind, None)
+    if used <= limit:
+      return False
+    settled = self._settled.get(kind)
+    return settled is None or used > settled + limit * (1 - REARM_RATIO)
+
+  def _settle(self, kind: str, used: int, limit_mb: float) -> None:
+    "Note what an intervention left, so the next waits for a change."
+    if used >= limit_mb * 1024**2 * REARM_RATIO:
+      self._settled[kind] = used
+    else:
+      self._settled.pop(kind, None)
+
+  def _check_rss(self) -> None:
+    rss = rss_bytes()
+    RSS_BYTES.set(rss)
+    if self.rss_limit_mb <= 0 or not self._due("rss", rss, self.rss_limit_mb):
+      return
+
+    self._release(self.releases)
+    gc.collect()
+    if _libc is not None:
+      _libc.malloc_trim(0)
+    INTERVENTIONS.inc(kind="rss")
+    after = rss_bytes()
+    self._settle("rss", after, self.rss_limit_mb)
+    LOG.info(
+      f"Resident memory {rss / 1024**2:.0f} MB was over "
+      f"{self.rss_limit_mb} MB, now {after / 1024**2:.0f} MB"
+    )
+
+  def _check_device(self) -> None:
+    if self.device_limit_mb <= 0:
+      return
+    used = device_bytes()
+    if used is None:
+      return
+    DEVICE_BYTES.set(used)
+    if not self._due("device", used, self.device_limit_mb):
+      return
+
+    self._release(self.device_releases)
+    # Models are freed once the last reference to them goes.
+    gc.collect()
+    INTERVENTIONS.inc(kind="device")
+    after = device_bytes()
+    self._settle("device", after, self.device_limit_mb)
+    LOG.info(
+      f"Device memory {used / 1024**2:.0f} MB was over "
+      f"{self.device_limit_mb} MB, now {after / 1024**2:.0f} MB"
+    )
+
+  def _release(self, releases: list[Callable[[], None]]) -> None:
+    for release in releases:
+      try:
+        release()
+      except Exception:
+        LOG.exception("Failed releasing memory")
+
+
+governor = MemoryGovernor(
+  rss_limit_mb=RSS_LIMIT_MB, device_limit_mb=DEVICE_LIMIT_MB
+)
@@ -0,0 +1,266 @@
+# Metrics for the transcription pipeline, exposed in Prometheus text format
+from __future__ import annotations
+
+import contextlib
+import time
+from bisect import bisect_left
+from typing import TYPE_CHECKING
+
+from aiohttp.web import Response, middleware
+
+if TYPE_CHECKING:
+  from typing import Callable, Iterator
+
+  from aiohttp.web import Request
+
+# Seconds, from a cached hit up to a long recording on a slow machine.
+DEFAULT_BUCKETS = (
+  0.005,
+  0.01,
+  0.025,
+  0.05,
+  0.1,
+  0.25,
+  0.5,
+  1.0,
+  2.5,
+  5.0,
+  10.0,
+  30.0,
+  60.0,
+  120.0,
+  300.0,
+)
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues) -> str:
+  if not names:
+    return ""
+  pairs = ",".join(
+    f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+  )
+  return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+  if value == float("inf"):
+    return "+Inf"
+  return repr(value)
+
+
+class Metric:
+  "A named family of samples, one per combination of label values."
+
+  kind = "untyped"
+  name: str
+  documentation: str
+  labels: tuple[str, ...]
+
+  def __init__(
+    self, name: str, documentation: str, labels: tuple[str, ...] = ()
+  ) -> None:
+    self.name = name
+    self.documentation = documentation
+    self.labels = labels
+    registry.append(self)
+
+  def _key(self, labels: dict[str, str]) -> LabelValues:
+    return tuple(str(labels[name]) for name in self.labels)
+
+  def samples(self) -> Iterator[tuple[str, str, float]]:
+    raise NotImplementedError
+
+  def render(self) -> list[str]:
+    lines = [
+      f"# HELP {self.name} {self.documentation}",
+      f"# TYPE {self.name} {self.kind}",
+    ]
+    for name, labels, value in self.samples():
+      lines.append(f"{name}{labels} {_format_value(value)}")
+    return lines
+
+
+class Counter(Metric):
+  kind = "counter"
+
+  def __init__(self, *args, **kwargs) -> None:
+    super().__init__(*args, **kwargs)
+    self.values: dict[LabelValues, float] = {}
+
+  def inc(self, amount: float = 1, **labels: str) -> None:
+    key = self._key(labels)
+    self.values[key] = self.values.get(key, 0) + amount
+
+  def samples(self) -> Iterator[tuple[str, str, float]]:
+    for key, value in self.values.items():
+      yield f"{self.name}_total", _format_labels(self.labels, key), value
+
+
+class Gauge(Metric):
+  """A value that goes up and down. With `function` it is read when scraped
+  instead, for things like queue sizes that already exist elsewhere."""
+
+  kind = "gauge"
+
+  def __init__(
+    self, *args, function: Callable[[], float] = None, **kwargs
+  ) -> None:
+    super().__init__(*args, **kwargs)
+    self.function = function
+    self.values: dict[LabelValues, float] = {}
+
+  def set(self, value: float, **labels: str) -> None:
+    self.values[self._key(labels)] = value
+
+  def inc(self, amount: float = 1, **labels: str) -> None:
+    key = self._key(labels)
+    self.values[key] = self.values.get(key, 0) + amount
+
+  def dec(self, amount: float = 1, **labels: str) -> None:
+    self.inc(-amount, **labels)
+
+  @contextlib.contextmanager
+  def track(self, **labels: str) -> Iterator[None]:
+    "Count the code inside the block as in progress while it runs."
+    self.inc(**labels)
+    try:
+      yield
+    finally:
+      self.dec(**labels)
+
+  def samples(self) -> Iterator[tuple[str, str, float]]:
+    if self.function is not None:
+      yield self.name, "", self.function()
+      return
+    for key, value in self.values.items():
+      yield self.name, _format_labels(self.labels, key), value
+
+
+class Histogram(Metric):
+  kind = "histogram"
+
+  def __init__(
+    self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs
+  ) -> None:
+    super().__init__(*args, **kwargs)
+    self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+    # label values -> (per bucket counts, sum)
+    self.values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+  def observe(self, value: float, **labels: str) -> None:
+    key = self._key(labels)
+    entry = self.values.get(key)
+    if entry is None:
+      entry = self.values[key] = ([0] * len(self.buckets), [0.0])
+    entry[0][bisect_left(self.buckets, value)] += 1
+    entry[1][0] += value
+
+  @contextlib.contextmanager
+  def time(self, **labels: str) -> Iterator[None]:
+    "Observe how many seconds the code inside the block took."
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def samples(self) -> Iterator[tuple[str, str, float]]:
+    names = self.labels + ("le",)
+    for key, (counts, total) in self.values.items():
+      cumulative = 0
+      for bound, count in zip(self.buckets, counts):
+        cumulative += count
+        labels = _format_labels(names, key + (_format_value(bound),))
+        yield f"{self.name}_bucket", labels, cumulative
+      labels = _format_labels(self.labels, key)
+      yield f"{self.name}_sum", labels, total[0]
+      yield f"{self.name}_count", labels, cumulative
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+  lines = []
+  for metric in registry:
+    lines.extend(metric.render())
+  return "\n".join(lines) + "\n"
+
+
+REQUESTS = Counter(
+  "whisper_http_requests",
+  "HTTP requests handled, by route and status code.",
+  ("method", "route", "status"),
+)
+REQUEST_SECONDS = Histogram(
+  "whisper_http_request_seconds",
+  "Time spent handling HTTP requests, by route.",
+  ("method", "route"),
+)
+QUEUE_WAIT_SECONDS = Histogram(
+  "whisper_queue_wait_seconds",
+  "Time a transcription waited for a free model runner.",
+)
+DECODE_SECONDS = Histogram(
+  "whisper_decode_seconds",
+  "Time spent decoding uploaded audio to PCM.",
+)
+INFERENCE_SECONDS = Histogram(
+  "whisper_inference_seconds",
+  "Time spent running one batch through the model.",
+)
+REAL_TIME_FACTOR = Histogram(
+  "whisper_real_time_factor",
+  "Seconds of audio transcribed per second of processing.",
+  buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+BATCH_SIZE = Histogram(
+  "whisper_batch_size",
+  "Transcriptions per model batch.",
+  buckets=(1, 2, 4, 8, 16, 32),
+)
+IN_FLIGHT = Gauge(
+  "whisper_in_flight_jobs",
+  "Transcriptions currently running on the model.",
+)
+
+
+def route_name(request: Request) -> str:
+  "The route's pattern rather than the path, so ids don't explode the labels."
+  route = request.match_info.route
+  if route.resource is None:
+    return "unmatched"
+  return route.resource.canonical
+
+
+@middleware
+async def metrics_middleware(request: Request, handler):
+  start = time.perf_counter()
+  status = 500
+  try:
+    resp = await handler(request)
+    status = resp.status if resp is not None else 204
+    return resp
+  except Exception as e:
+    status = getattr(e, "status", 500)
+    raise
+  finally:
+    route = route_name(request)
+    REQUESTS.inc(method=request.method, route=route, status=str(status))
+    REQUEST_SECONDS.observe(
+      time.perf_counter() - start, method=request.method, route=route
+    )
+
+
+async def get_metrics(request: Request) -> Response:
+  "Every metric in the Prometheus text exposition format."
+  return Response(
+    body=render().encode(),
+    headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+  )
@@ -0,0 +1,166 @@
+# Registry of loaded Whisper models, kept within a memory budget
+from __future__ import annotations
+
+import logging
+import threading
+import tomllib
+from collections import OrderedDict
+
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+
+MODEL_SIZE = config["model"]["model"]
+DEVICE = config["model"]["device"]
+DEVICE_INDEX = config["model"]["device_idx"]
+# Written by `python -m tools.autotune`. Its settings stand in for any of
+# compute_type, workers and cpu_threads that config.toml leaves out.
+TUNING_FILE = config["model"].get("tuning_file", "tuning.toml")
+
+LOG = logging.getLogger(__name__)
+
+
+def _load_tuning() -> dict:
+  "The tuned settings, if they were measured for this model and device."
+  try:
+    with open(TUNING_FILE) as f:
+      tuning = tomllib.loads(f.read()).get("model", {})
+  except FileNotFoundError:
+    return {}
+  if (tuning.get("model"), tuning.get("device")) != (MODEL_SIZE, DEVICE):
+    LOG.warning(
+      f"Ignoring {TUNING_FILE}, it was tuned for {tuning.get('model')} "
+      f"on {tuning.get('device')}"
+    )
+    return {}
+  return tuning
+
+
+tuning = _load_tuning()
+COMPUTE_TYPE = config["model"].get(
+  "compute_type", tuning.get("compute_type", "default")
+)
+
+# Models a request may ask for. Anything else would let clients make us
+# download arbitrary repositories.
+ALLOWED_MODELS = config["model"].get("allowed", [MODEL_SIZE])
+COMPUTE_TYPES = (
+  "default",
+  "auto",
+  "int8",
+  "int8_float32",
+  "int8_float16",
+  "int8_bfloat16",
+  "int16",
+  "float16",
+  "bfloat16",
+  "float32",
+)
+MEMORY_BUDGET_MB = config["model"].get("memory_budget_mb", 4096)
+
+# Rough resident size of each model family at 16 bit precision, used to decide
+# what to evict. model.model_mb overrides or extends it.
+MODEL_MB = {
+  "tiny": 75,
+  "base": 145,
+  "small": 470,
+  "medium": 1500,
+  "large": 3100,
+  "distil-large": 1500,
+  "turbo": 1600,
+  **config["model"].get("model_mb", {}),
+}
+
+ModelKey = tuple[str, str]
+
+
+def estimate_mb(name: str, compute_type: str) -> float:
+  matches = [family for family in MODEL_MB if family in name]
+  size = MODEL_MB[max(matches, key=len)] if matches else MODEL_MB["medium"]
+  if compute_type == "float32":
+    return size * 2
+  if compute_type.startswith("int8"):
+    return size / 2
+  return size
+
+
+class ModelRegistry:
+  """Loads models on first use and keeps the most recently used ones
+  resident while their estimated size fits in `budget_mb`.
+
+  Thread safe, since models are requested from executor threads. Concurrent
+  requests for a model that is still loading wait for that one load."""
+
+  budget_mb: float
+  cpu_threads: int
+  models: OrderedDict[ModelKey, BatchedInferencePipeline]
+
+  def __init__(self, *, budget_mb: float, cpu_threads: int = 0) -> None:
+    self.budget_mb = budget_mb
+    self.cpu_threads = cpu_threads
+    self.models = OrderedDict()
+    self.sizes: dict[ModelKey, float] = {}
+    self._lock = threading.Lock()
+    self._loading: dict[ModelKey, threading.Lock] = {}
+
+  @property
+  def used_mb(self) -> float:
+    return sum(self.sizes.values())
+
+  def _cached(self, key: ModelKey) -> BatchedInferencePipeline | None:
+    pipeline = self.models.get(key)
+    if pipeline is not None:
+      self.models.move_to_end(key)
+    return pipeline
+
+  def _make_room(self, size: float) -> None:
+    while self.models and self.used_mb + size > self.budget_mb:
+      key, _ = self.models.popitem(last=False)
+      del self.sizes[key]
+      # Batches still running on it keep it alive until they finish.
+      LOG.info(f"Evicted model {key[0]} ({key[1]}) to stay within budget")
+
+  def trim(self) -> None:
+    "Drop every model but the one used most recently."
+    with self._lock:
+      while len(self.models) > 1:
+        key, _ = self.models.popitem(last=False)
+        del self.sizes[key]
+        LOG.info(f"Evicted model {key[0]} ({key[1]}) to free device memory")
+
+  def get(
+    self, name: str = MODEL_SIZE, compute_type: str = COMPUTE_TYPE
+  ) -> BatchedInferencePipeline:
+    key = (name, compute_type)
+    with self._lock:
+      pipeline = self._cached(key)
+      if pipeline is not None:
+        return pipeline
+      load_lock = self._loading.setdefault(key, threading.Lock())
+
+    with load_lock:
+      with self._lock:
+        pipeline = self._cached(key)
+        if pipeline is not None:
+          return pipeline
+        size = estimate_mb(name, compute_type)
+        # Evict first, so the old and new models are never resident at once.
+        self._make_room(size)
+
+      LOG.info(f"Loading model {name} ({compute_type})...")
+      pipeline = BatchedInferencePipeline(
+        WhisperModel(
+          name,
+          device=DEVICE,
+          device_index=DEVICE_INDEX,
+          compute_type=compute_type,
+          cpu_threads=self.cpu_threads,
+        )
+      )
+
+      with self._lock:
+        self.models[key] = pipeline
+        self.sizes[key] = size
+        self._loading.pop(key, None)
+      return pipeline
@@ -26,7 +26,7 @@ async def pg_pool_middleware(request: Request, handler):
   except Exception:
     request.LOG.exception(f"Request to {request.path} failed!")
     resp = Response(status=500,body="internal server error")
-  request.LOG.info(
+  request.LOG.debug(
     f"call to {request.path} took {(time.monotonic_ns()-start)/1000} microseconds"
   )
   if resp is None:
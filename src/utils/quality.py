@@ -0,0 +1,83 @@
+# Decoding profiles that clients pick between with quality=
+from __future__ import annotations
+
+import tomllib
+
+from utils.models import ALLOWED_MODELS, COMPUTE_TYPES
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+
+# Built in settings for each tier. A [quality.<tier>] table in the config
+# overrides any of them, which is where a deployment names the model and
+# compute type each tier should use, since which are worth loading depends
+# on the hardware.
+DEFAULT_PROFILES = {
+  "fast": {"beam_size": 1, "use_vad": True},
+  "balanced": {"beam_size": 5},
+  "accurate": {"beam_size": 10, "patience": 2},
+}
+DEFAULT_QUALITY = config.get("quality", {}).get("default", "balanced")
+
+
+class Profile:
+  """How to decode for one quality tier. `model` and `compute_type` of None
+  use the server's defaults. With `use_vad`, silence is cut out before
+  decoding. `speedup` plays the audio that much faster, which also raises
+  its pitch, so it is off unless a deployment has measured that its model
+  still copes. Timestamps are mapped back to the original audio either
+  way."""
+
+  name: str
+  model: str | None
+  compute_type: str | None
+  beam_size: int
+  patience: float
+  use_vad: bool
+  speedup: float
+
+  def __init__(
+    self,
+    name: str,
+    *,
+    model: str = None,
+    compute_type: str = None,
+    beam_size: int = 5,
+    patience: float = 1,
+    use_vad: bool = False,
+    speedup: float = 1.0,
+  ) -> None:
+    if model is not None and model not in ALLOWED_MODELS:
+      raise ValueError(
+        f"quality {name} uses model {model}, which isn't allowed"
+      )
+    if compute_type is not None and compute_type not in COMPUTE_TYPES:
+      raise ValueError(
+        f"quality {name} has unknown compute type {compute_type}"
+      )
+    self.name = name
+    self.model = model
+    self.compute_type = compute_type
+    self.beam_size = beam_size
+    self.patience = patience
+    self.use_vad = use_vad
+    self.speedup = speedup
+
+  def options(self) -> dict:
+    "Keyword arguments of TranscriptionJob for this profile."
+    options = {
+      "beam_size": self.beam_size,
+      "patience": self.patience,
+      "speedup": self.speedup,
+    }
+    if self.model is not None:
+      options["model"] = self.model
+    if self.compute_type is not None:
+      options["compute_type"] = self.compute_type
+    return options
+
+
+PROFILES = {
+  name: Profile(name, **{**defaults, **config.get("quality", {}).get(name, {})})
+  for name, defaults in DEFAULT_PROFILES.items()
+}
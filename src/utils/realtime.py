@@ -0,0 +1,122 @@
+# Live transcription of a continuous PCM stream
+from __future__ import annotations
+
+import tomllib
+
+import numpy
+from faster_whisper.vad import VadOptions
+
+from utils.audio import SAMPLE_RATE, detect_speech
+from utils.whisper import transcribe_array
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+
+# How much new audio triggers another pass over the unconfirmed tail, and the
+# longest tail kept before it is finalised regardless of pauses.
+STEP = config.get("realtime", {}).get("step_s", 1.0)
+MAX_WINDOW = config.get("realtime", {}).get("max_window_s", 25.0)
+MIN_SILENCE_MS = config.get("realtime", {}).get("min_silence_ms", 600)
+
+
+class RealtimeSession:
+  """Rolling buffer for one live stream.
+
+  Audio up to the last pause VAD is sure about is transcribed one final time
+  and dropped from the buffer. Everything after it is the unconfirmed tail,
+  which is re-decoded every `step` seconds and sent as a partial hypothesis.
+  """
+
+  buffer: numpy.ndarray
+  offset: float
+  pending: int
+  partial: str
+
+  def __init__(
+    self,
+    *,
+    step: float = STEP,
+    max_window: float = MAX_WINDOW,
+    min_silence_ms: int = MIN_SILENCE_MS,
+  ) -> None:
+    self.step = int(step * SAMPLE_RATE)
+    self.max_window = int(max_window * SAMPLE_RATE)
+    self.vad_options = VadOptions(
+      min_silence_duration_ms=min_silence_ms, speech_pad_ms=100
+    )
+    self.min_silence = min_silence_ms * SAMPLE_RATE // 1000
+    self.pad = self.vad_options.speech_pad_ms * SAMPLE_RATE // 1000
+    self.buffer = numpy.zeros(0, dtype=numpy.float32)
+    # Session time of buffer[0], in seconds.
+    self.offset = 0.0
+    self.pending = 0
+    self.partial = ""
+    # A sample split between two frames waits here for its second byte.
+    self.carry = b""
+
+  def feed(self, pcm: bytes) -> None:
+    "Append 16 kHz mono s16le audio. Frames needn't hold whole samples."
+    if self.carry:
+      pcm = self.carry + pcm
+    usable = len(pcm) - len(pcm) % 2
+    self.carry = pcm[usable:]
+    audio = numpy.frombuffer(pcm, numpy.int16, count=usable // 2)
+    audio = audio.astype(numpy.float32)
+    audio *= 1 / 32768.0
+    self.buffer = numpy.concatenate((self.buffer, audio))
+    self.pending += audio.shape[0]
+
+  @property
+  def ready(self) -> bool:
+    return self.pending >= self.step
+
+  def _advance(self, samples: int) -> None:
+    self.buffer = self.buffer[samples:]
+    self.offset += samples / SAMPLE_RATE
+
+  def _message(self, kind: str, text: str, samples: int) -> dict:
+    return {
+      "type": kind,
+      "text": text,
+      "start": round(self.offset, 3),
+      "end": round(self.offset + samples / SAMPLE_RATE, 3),
+    }
+
+  async def _find_cut(self) -> int | None:
+    "Where the settled part of the buffer ends, if anywhere yet."
+    speech = await detect_speech(self.buffer, self.vad_options)
+    if not speech:
+      # Only silence so far. Keep a little in case speech is just starting.
+      self._advance(max(0, self.buffer.shape[0] - self.pad))
+      return None
+
+    if self.buffer.shape[0] - speech[-1]["end"] >= self.min_silence:
+      return speech[-1]["end"]
+    if len(speech) > 1:
+      return (speech[-2]["end"] + speech[-1]["start"]) // 2
+    if self.buffer.shape[0] >= self.max_window:
+      # One long run of speech, cut it where the current utterance began.
+      return speech[-1]["start"] or self.buffer.shape[0]
+    return None
+
+  async def process(self, *, final: bool = False) -> list[dict]:
+    "Re-decode the buffer and return the messages to send to the client."
+    self.pending = 0
+    messages = []
+
+    cut = self.buffer.shape[0] if final else await self._find_cut()
+    if cut:
+      result = await transcribe_array(self.buffer[:cut])
+      if result.full_text:
+        messages.append(self._message("final", result.full_text, cut))
+      self._advance(cut)
+      self.partial = ""
+
+    if not final and self.buffer.shape[0] > self.pad:
+      result = await transcribe_array(self.buffer)
+      if result.full_text != self.partial:
+        self.partial = result.full_text
+        messages.append(
+          self._message("partial", result.full_text, self.buffer.shape[0])
+        )
+    return messages
@@ -1,32 +1,167 @@
 from __future__ import annotations
 
 import asyncio
-import gc
-import random
-import string
+import bisect
+import contextlib
+import contextvars
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import threading
 import time
 import tomllib
 from typing import TYPE_CHECKING
 
-import aiofiles
-import aiofiles.os
 import numpy
-import torch
-from faster_whisper import WhisperModel
+import orjson
+from faster_whisper.audio import pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.transcribe import (
+  Segment,
+  TranscriptionInfo,
+  TranscriptionOptions,
+  Word,
+  get_suppressed_tokens,
+)
+from faster_whisper.vad import (
+  SpeechTimestampsMap,
+  VadOptions,
+  collect_chunks,
+  get_vad_model,
+)
+
+from utils.audio import Upload, decode, detect_speech
+from utils.cache import LRUCache, ResultCache, SingleFlight
+from utils.formats import dumps, result_packet
+from utils.memory import governor
+from utils.metrics import (
+  BATCH_SIZE,
+  IN_FLIGHT,
+  INFERENCE_SECONDS,
+  QUEUE_WAIT_SECONDS,
+  REAL_TIME_FACTOR,
+  Gauge,
+)
+from utils.models import (
+  COMPUTE_TYPE,
+  MEMORY_BUDGET_MB,
+  MODEL_SIZE,
+  ModelRegistry,
+  tuning,
+)
+from utils.workers import WorkerPool
 
 if TYPE_CHECKING:
-  from faster_whisper.transcribe import Segment, TranscriptionInfo
+  from typing import Any, AsyncIterator, Awaitable, Callable, Iterator
+
+  from asyncpg import Pool
+  from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+  from utils.models import ModelKey
 
 with open("config.toml") as f:
   config = tomllib.loads(f.read())
 
-MODEL_SIZE = config["model"]["model"]
-DEVICE = config["model"]["device"]
-DEVICE_INDEX = config["model"]["device_idx"]
+# How long the scheduler waits for more requests to join a batch, and how many
+# requests (and 30 second feature windows) go through the model at once.
+BATCH_WINDOW = config["model"].get("batch_window_ms", 25) / 1000
+MAX_BATCH_SIZE = config["model"].get("max_batch_size", 8)
+
+# With workers > 0 every batch runs in one of that many inference processes,
+# each with its own model; otherwise the model lives in the server process.
+WORKERS = config["model"].get("workers", tuning.get("workers", 0))
+CPU_THREADS = config["model"].get("cpu_threads", tuning.get("cpu_threads", 0))
+
+# Identical uploads are served from a cache of results (optionally backed by
+# Postgres) and of decoded audio, so a changed vad_* option skips decoding.
+# Results in memory are bounded by their size as JSON, and rows in Postgres
+# expire after expire_after_s.
+CACHE_MB = config.get("cache", {}).get("memory_mb", 64)
+CACHE_EXPIRE_AFTER = config.get("cache", {}).get("expire_after_s", 7 * 86400)
+CACHE_POSTGRES = config.get("cache", {}).get("postgres", False)
+PCM_CACHE_MB = config.get("cache", {}).get("pcm_mb", 256)
+
+# Requests go through a bounded decode stage, then wait decoded in a bounded
+# ready queue for the model, so the next batch is ready the moment a runner
+# frees up. Full stages make the callers in front of them wait.
+DECODE_CONCURRENCY = config.get("pipeline", {}).get("decode_concurrency", 8)
+READY_QUEUE_SIZE = config.get("pipeline", {}).get(
+  "ready_queue", MAX_BATCH_SIZE * 4
+)
+
+# long=true splits recordings at pauses into chunks of about this length and
+# transcribes them concurrently.
+LONG_CHUNK_S = config["model"].get("long_chunk_s", 120)
+# How far into a file language detection looks for speech when using VAD.
+DETECT_SCAN_S = config["model"].get("detect_scan_s", 120)
+
+SAMPLE_RATE = 16000
+# Length of the model's input window.
+WINDOW_S = 30
+# Finds the pauses that audio longer than a window is cut at, as faster-whisper
+# does for its own batched transcription.
+PAUSE_VAD_OPTIONS = VadOptions(min_silence_duration_ms=160)
+# Mel frames per second, the unit of Segment.seek.
+FRAMES_PER_SECOND = SAMPLE_RATE // 160
+# Length of the anti-aliasing filter run before speeding audio up.
+LOWPASS_TAPS = 63
+
+LOG = logging.getLogger(__name__)
+
+# The default model is loaded in the background by start(), so the server can
+# take connections right away. state goes not-ready -> loading -> ready (or
+# failed). Other models a request asks for are loaded on first use.
+registry = ModelRegistry(budget_mb=MEMORY_BUDGET_MB, cpu_threads=CPU_THREADS)
+# In every process holding models, the workers included.
+governor.on_device_pressure(registry.trim)
+state = "not-ready"
+_ready = asyncio.Event()
+_loading: asyncio.Task | None = None
+# Models resident in every runner as of the last load. Loading one can evict
+# others, so each load replaces it. A model evicted or lost with a restarted
+# worker anyway is loaded again by the batch that needs it.
+_resident: set[ModelKey] = set()
+model_loads = SingleFlight()
+
+
+def load_model(*, cpu_threads: int = CPU_THREADS) -> None:
+  "Load the default model, giving it and any later model `cpu_threads`."
+  registry.cpu_threads = cpu_threads
+  registry.get()
+
+
+def _load_model(name: str, compute_type: str) -> list[ModelKey]:
+  "Load a model unless it is resident, and return every model that is."
+  registry.get(name, compute_type)
+  return list(registry.models)
 
-model = WhisperModel(MODEL_SIZE, device=DEVICE, device_index=DEVICE_INDEX)
 
-model_lock = asyncio.Lock()
+async def _load_everywhere(key: ModelKey) -> None:
+  global _resident
+  if worker_pool is not None:
+    resident = await worker_pool.each("_load_model", *key)
+    _resident = set.intersection(*(set(keys) for keys in resident))
+  else:
+    loop = asyncio.get_running_loop()
+    _resident = set(await loop.run_in_executor(None, _load_model, *key))
+
+
+async def ensure_model(model: str = None, compute_type: str = None) -> None:
+  """Load a model before anything that needs it is queued, so the load, and
+  any download, happens outside the batch runners and only the requests for
+  that model wait on it."""
+  await wait_until_ready()
+  key = (model or MODEL_SIZE, compute_type or COMPUTE_TYPE)
+  if key not in _resident:
+    await model_loads.run(key, lambda: _load_everywhere(key))
+
+
+async def wait_until_ready() -> None:
+  await _ready.wait()
+  if state != "ready":
+    raise RuntimeError("the model failed to load")
 
 
 class TranscriptionResult:
@@ -45,111 +180,1228 @@ class TranscriptionResult:
   def full_text(self) -> str:
     return " ".join(segment.text.strip() for segment in self.segments)
 
+  def to_json(self) -> bytes:
+    """The result as stored outside the process: its json output, which has
+    everything any output format needs, and unlike a pickle can't run code
+    or break when faster-whisper's classes change."""
+    return dumps(result_packet(self))
 
-def _transcribe_file(
-  file_path: str, use_vad: bool = False, vad_options: dict[str, float] = None
-) -> TranscriptionResult:
-  "Take in PCM WAV 16 bit bytes, return transcribed text"
-  segments, info = model.transcribe(
-    file_path, vad_filter=use_vad, vad_parameters=vad_options
-  )
+  @classmethod
+  def from_json(cls, data: bytes) -> TranscriptionResult:
+    """Rebuild a result stored with to_json(). Fields the output formats
+    don't use are zeroed. Raises ValueError if `data` isn't one."""
+    try:
+      packet = orjson.loads(data)
+      segments = [
+        Segment(
+          id=idx,
+          seek=0,
+          start=segment["start"],
+          end=segment["end"],
+          text=segment["text"],
+          tokens=[],
+          avg_logprob=0.0,
+          compression_ratio=0.0,
+          no_speech_prob=0.0,
+          words=[
+            Word(
+              start=word["start"],
+              end=word["end"],
+              word=word["word"],
+              probability=word["probability"],
+            )
+            for word in segment["words"]
+          ]
+          or None,
+          temperature=0.0,
+        )
+        for idx, segment in enumerate(packet["segments"], 1)
+      ]
+      info = TranscriptionInfo(
+        language=packet["language"],
+        language_probability=packet["language_probability"],
+        duration=packet["duration"],
+        duration_after_vad=packet["duration"],
+        all_language_probs=None,
+        transcription_options=None,
+        vad_options=None,
+      )
+    except (KeyError, TypeError) as e:
+      raise ValueError(f"not a stored result: {e!r}") from None
+    return cls(segments, info)
 
-  segments = list(segments)
-  result = TranscriptionResult(segments, info)
-  return result
 
+class TranscriptionJob:
+  """Audio for the model, and how to decode it. `windows` are the sample
+  ranges it is decoded in, which transcribe_array and transcribe_stream cut
+  at pauses or around speech found ahead of time. Without them it is cut
+  into back to back 30 second windows."""
 
-async def transcribe_file(
-  audio_bytes: bytes,
+  audio: numpy.ndarray
+  windows: list[dict[str, int]] | None
+  model: str
+  compute_type: str
+  word_timestamps: bool
+  beam_size: int
+  patience: float
+  speedup: float
+
+  def __init__(
+    self,
+    audio: numpy.ndarray,
+    *,
+    windows: list[dict[str, int]] = None,
+    model: str = None,
+    compute_type: str = None,
+    word_timestamps: bool = False,
+    beam_size: int = 5,
+    patience: float = 1,
+    speedup: float = 1.0,
+  ) -> None:
+    self.audio = audio
+    self.windows = windows
+    self.model = model or MODEL_SIZE
+    self.compute_type = compute_type or COMPUTE_TYPE
+    self.word_timestamps = word_timestamps
+    self.beam_size = beam_size
+    self.patience = patience
+    self.speedup = speedup
+
+
+class _PreparedJob:
+  "Feature windows and detected language for one job, ready for batching."
+
+  features: list[numpy.ndarray]
+  chunks_metadata: list[dict[str, float]]
+  language: str
+  language_prob: float
+  all_language_probs: list[tuple[str, float]] | None
+  duration: float
+  duration_after_vad: float
+  word_timestamps: bool
+  beam_size: int
+  patience: float
+  speedup: float
+  segments: list[dict]
+
+  def __init__(self, **kwargs) -> None:
+    for key, value in kwargs.items():
+      setattr(self, key, value)
+    self.segments = []
+
+  @property
+  def group(self) -> _Group:
+    "Jobs whose windows can share a forward pass have the same group."
+    return (self.language, self.word_timestamps, self.beam_size, self.patience)
+
+
+def _time_compress(audio: numpy.ndarray, speedup: float) -> numpy.ndarray:
+  """Play `audio` `speedup` times faster by resampling it, which raises its
+  pitch by as much. It is low-passed below the new Nyquist frequency first,
+  so nothing above that aliases back down into the speech band."""
+  taps = numpy.arange(LOWPASS_TAPS) - (LOWPASS_TAPS - 1) / 2
+  kernel = numpy.sinc(taps / speedup) * numpy.hanning(LOWPASS_TAPS)
+  kernel = (kernel / kernel.sum()).astype(numpy.float32)
+  filtered = numpy.convolve(audio, kernel, mode="same")
+
+  length = int(audio.shape[0] / speedup)
+  positions = numpy.arange(length, dtype=numpy.float32) * speedup
+  samples = numpy.arange(audio.shape[0], dtype=numpy.float32)
+  return numpy.interp(positions, samples, filtered).astype(numpy.float32)
+
+
+def _prepare_job(job: TranscriptionJob, model: WhisperModel) -> _PreparedJob:
+  """Split a job's audio into 30 second windows and detect its language.
+  Sped up audio is prepared on its own timeline, which _segment undoes."""
+  audio = job.audio
+  duration = audio.shape[0] / SAMPLE_RATE
+  if job.speedup != 1:
+    audio = _time_compress(audio, job.speedup)
+
+  if job.windows is not None:
+    clips = [
+      {
+        "start": int(clip["start"] / job.speedup),
+        "end": min(int(clip["end"] / job.speedup), audio.shape[0]),
+      }
+      for clip in job.windows
+    ]
+  else:
+    step = WINDOW_S * SAMPLE_RATE
+    clips = [
+      {"start": start, "end": min(start + step, audio.shape[0])}
+      for start in range(0, audio.shape[0], step)
+    ]
+
+  duration_after_vad = sum(clip["end"] - clip["start"] for clip in clips)
+  duration_after_vad /= SAMPLE_RATE
+
+  features = []
+  chunks_metadata = []
+  if duration_after_vad:
+    audio_chunks, chunks_metadata = collect_chunks(audio, clips)
+    features = [
+      model.feature_extractor(chunk)[..., :-1] for chunk in audio_chunks
+    ]
+
+  all_language_probs = None
+  if not model.model.is_multilingual:
+    language, language_prob = "en", 1
+  else:
+    # The dummy frame keeps detection working on empty audio.
+    dummy = numpy.full((model.model.n_mels, 1), -1.5, dtype=numpy.float32)
+    language, language_prob, all_language_probs = model.detect_language(
+      features=numpy.concatenate(features + [dummy], axis=1)
+    )
+
+  return _PreparedJob(
+    features=[pad_or_trim(feature) for feature in features],
+    chunks_metadata=chunks_metadata,
+    language=language,
+    language_prob=language_prob,
+    all_language_probs=all_language_probs,
+    duration=duration,
+    duration_after_vad=duration_after_vad,
+    word_timestamps=job.word_timestamps,
+    beam_size=job.beam_size,
+    patience=job.patience,
+    speedup=job.speedup,
+  )
+
+
+def _transcription_options(
+  tokenizer: Tokenizer,
   *,
-  use_vad: bool = False,
-  vad_options: dict[str, float] = None,
-) -> TranscriptionResult:
+  word_timestamps: bool = False,
+  beam_size: int = 5,
+  patience: float = 1,
+) -> TranscriptionOptions:
+  """The decode options used for every batched window. Word timestamps cost
+  an extra alignment pass, so they are only worked out when asked for."""
+  return TranscriptionOptions(
+    beam_size=beam_size,
+    best_of=5,
+    patience=patience,
+    length_penalty=1,
+    repetition_penalty=1,
+    no_repeat_ngram_size=0,
+    log_prob_threshold=-1.0,
+    no_speech_threshold=0.6,
+    compression_ratio_threshold=2.4,
+    condition_on_previous_text=False,
+    prompt_reset_on_temperature=0.5,
+    temperatures=[0.0],
+    initial_prompt=None,
+    prefix=None,
+    suppress_blank=True,
+    suppress_tokens=get_suppressed_tokens(tokenizer, [-1]),
+    without_timestamps=False,
+    max_initial_timestamp=0.0,
+    word_timestamps=word_timestamps,
+    prepend_punctuations="\"'“¿([{-",
+    append_punctuations="\"'.。,，!！?？:：”)]}、",
+    multilingual=False,
+    max_new_tokens=None,
+    clip_timestamps=None,
+    hallucination_silence_threshold=None,
+    hotwords=None,
+  )
+
+
+def _tokenizer(model: WhisperModel, language: str) -> Tokenizer:
+  return Tokenizer(
+    model.hf_tokenizer,
+    model.model.is_multilingual,
+    task="transcribe",
+    language=language,
+  )
+
+
+def _segment(idx: int, segment: dict, speedup: float = 1.0) -> Segment:
+  """Build a Segment from one of the pipeline's output dicts, moving its
+  times from sped up audio back to the original. Word timings come out of
+  the pipeline as numpy floats, which are made plain floats here so every
+  output format can encode them."""
+  words = None
+  if "words" in segment:
+    words = [
+      Word(
+        start=round(float(word["start"]) * speedup, 3),
+        end=round(float(word["end"]) * speedup, 3),
+        word=word["word"],
+        probability=float(word["probability"]),
+      )
+      for word in segment["words"]
+    ]
+  return Segment(
+    id=idx,
+    seek=round(segment["seek"] * speedup),
+    start=round(float(segment["start"]) * speedup, 3),
+    end=round(float(segment["end"]) * speedup, 3),
+    text=segment["text"],
+    tokens=segment["tokens"],
+    avg_logprob=float(segment["avg_logprob"]),
+    compression_ratio=float(segment["compression_ratio"]),
+    no_speech_prob=float(segment["no_speech_prob"]),
+    words=words,
+    temperature=0.0,
+  )
+
+
+def _info(
+  item: _PreparedJob, options: TranscriptionOptions
+) -> TranscriptionInfo:
+  return TranscriptionInfo(
+    language=item.language,
+    language_probability=item.language_prob,
+    duration=item.duration,
+    duration_after_vad=item.duration_after_vad * item.speedup,
+    all_language_probs=item.all_language_probs,
+    transcription_options=options,
+    vad_options=None,
+  )
+
+
+def _transcribe_batch(
+  jobs: list[TranscriptionJob],
+) -> list[TranscriptionResult | Exception]:
+  "Transcribe a batch of jobs, grouped by the model they asked for."
+  groups: dict[tuple[str, str], list[int]] = {}
+  for idx, job in enumerate(jobs):
+    groups.setdefault((job.model, job.compute_type), []).append(idx)
+
+  results: list[TranscriptionResult | Exception] = [None] * len(jobs)
+  for key, indexes in groups.items():
+    try:
+      pipeline = registry.get(*key)
+      group = _transcribe_group(pipeline, [jobs[idx] for idx in indexes])
+    except Exception as e:
+      group = [e] * len(indexes)
+    for idx, result in zip(indexes, group):
+      results[idx] = result
+  return results
+
+
+# A language, whether word timestamps were asked for, the beam size and the
+# beam search patience.
+_Group = tuple[str, bool, int, float]
+
+
+def _transcribe_group(
+  pipeline: BatchedInferencePipeline, jobs: list[TranscriptionJob]
+) -> list[TranscriptionResult | Exception]:
+  "Run every window of every job through the batched pipeline together."
+  prepared: list[_PreparedJob | Exception] = []
+  for job in jobs:
+    try:
+      prepared.append(_prepare_job(job, pipeline.model))
+    except Exception as e:
+      prepared.append(e)
+
+  # Windows can only share a forward pass if they share a language prompt,
+  # and the decode options, word alignment included, are set per pass.
+  groups: dict[_Group, list[tuple[_PreparedJob, numpy.ndarray, dict]]] = {}
+  for item in prepared:
+    if isinstance(item, Exception):
+      continue
+    windows = groups.setdefault(item.group, [])
+    for feature, metadata in zip(item.features, item.chunks_metadata):
+      windows.append((item, feature, metadata))
+
+  options_by_group: dict[_Group, TranscriptionOptions] = {}
+  for group, windows in groups.items():
+    language, word_timestamps, beam_size, patience = group
+    tokenizer = _tokenizer(pipeline.model, language)
+    options = _transcription_options(
+      tokenizer,
+      word_timestamps=word_timestamps,
+      beam_size=beam_size,
+      patience=patience,
+    )
+    options_by_group[group] = options
+    for i in range(0, len(windows), MAX_BATCH_SIZE):
+      batch = windows[i : i + MAX_BATCH_SIZE]
+      # The windows belong to unrelated recordings, so there is no speech
+      # before them for word alignment to carry over.
+      pipeline.last_speech_timestamp = 0.0
+      outputs = pipeline.forward(
+        numpy.stack([feature for _, feature, _ in batch]),
+        tokenizer,
+        [metadata for _, _, metadata in batch],
+        options,
+      )
+      for (item, _, _), output in zip(batch, outputs):
+        item.segments.extend(output)
+
+  results: list[TranscriptionResult | Exception] = []
+  for item in prepared:
+    if isinstance(item, Exception):
+      results.append(item)
+      continue
+    segments = [
+      _segment(idx, segment, item.speedup)
+      for idx, segment in enumerate(item.segments, 1)
+    ]
+    info = _info(item, options_by_group.get(item.group))
+    results.append(TranscriptionResult(segments, info))
+  return results
+
+
+def _transcribe_stream(
+  job: TranscriptionJob,
+) -> Iterator[TranscriptionInfo | Segment]:
+  "Yield the job's info as soon as its language is known, then each segment."
+  pipeline = registry.get(job.model, job.compute_type)
+  item = _prepare_job(job, pipeline.model)
+  tokenizer = _tokenizer(pipeline.model, item.language)
+  options = _transcription_options(
+    tokenizer,
+    word_timestamps=job.word_timestamps,
+    beam_size=job.beam_size,
+    patience=job.patience,
+  )
+  yield _info(item, options)
+  pipeline.last_speech_timestamp = 0.0
+
+  idx = 0
+  for i in range(0, len(item.features), MAX_BATCH_SIZE):
+    outputs = pipeline.forward(
+      numpy.stack(item.features[i : i + MAX_BATCH_SIZE]),
+      tokenizer,
+      item.chunks_metadata[i : i + MAX_BATCH_SIZE],
+      options,
+    )
+    for output in outputs:
+      for segment in output:
+        idx += 1
+        yield _segment(idx, segment, job.speedup)
+
+
+def _detect_language(
+  audio: numpy.ndarray, model: str, compute_type: str
+) -> list[tuple[str, float]]:
+  "Every language the model knows, most probable first."
+  pipeline = registry.get(model, compute_type)
+  if not pipeline.model.model.is_multilingual:
+    return [("en", 1.0)]
+  if not audio.shape[0]:
+    return []
+  _, _, all_language_probs = pipeline.model.detect_language(audio=audio)
+  return sorted(all_language_probs, key=lambda pair: pair[1], reverse=True)
+
+
+# A submitted job, the future for its result, and when it was submitted.
+_Queued = tuple[TranscriptionJob, asyncio.Future, float]
+
+
+class BatchScheduler:
+  """Collect requests that arrive within a short window and run them through
+  the model as one batch, handing each result back to its own caller."""
+
+  window: float
+  max_batch_size: int
+  queue: asyncio.Queue[_Queued]
+
+  def __init__(
+    self,
+    *,
+    window: float,
+    max_batch_size: int,
+    runner: Callable[
+      [list[TranscriptionJob]],
+      Awaitable[list[TranscriptionResult | Exception]],
+    ],
+    concurrency: int = 1,
+    queue_size: int = 0,
+    idle: Callable[[], None] = None,
+  ) -> None:
+    self.window = window
+    self.max_batch_size = max_batch_size
+    self.runner = runner
+    self.concurrency = concurrency
+    # Called on a thread whenever the model has nothing left to do.
+    self.idle = idle
+    self.queue = asyncio.Queue(maxsize=queue_size)
+    self._task: asyncio.Task | None = None
+    self._slots = asyncio.Semaphore(concurrency)
+    self._batches: set[asyncio.Task] = set()
+
+  async def submit(self, job: TranscriptionJob) -> TranscriptionResult:
+    await ensure_model(job.model, job.compute_type)
+    loop = asyncio.get_running_loop()
+    if self._task is None or self._task.done():
+      self._task = loop.create_task(self._run())
+
+    future = loop.create_future()
+    await self.queue.put((job, future, time.perf_counter()))
+    _leave_decode_stage()
+    return await future
+
+  @contextlib.asynccontextmanager
+  async def slot(self) -> AsyncIterator[None]:
+    "Hold one runner for work that can't be batched, such as streaming."
+    start = time.perf_counter()
+    async with self._slots:
+      QUEUE_WAIT_SECONDS.observe(time.perf_counter() - start)
+      _leave_decode_stage()
+      with IN_FLIGHT.track():
+        yield
+
+  async def _collect(self, first: _Queued) -> list[_Queued]:
+    loop = asyncio.get_running_loop()
+    batch = [first]
+    deadline = loop.time() + self.window
+    while len(batch) < self.max_batch_size:
+      timeout = deadline - loop.time()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+      except asyncio.TimeoutError:
+        break
+    return batch
+
+  async def _run(self) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+      # Wait for work before taking a runner, so an idle scheduler never
+      # holds one that slot() could use. Then only start collecting once a
+      # runner is free, so requests that arrive while every runner is busy
+      # end up in the same batch.
+      first = await self.queue.get()
+      await self._slots.acquire()
+      batch = await self._collect(first)
+      task = loop.create_task(self._dispatch(batch))
+      self._batches.add(task)
+      task.add_done_callback(self._batches.discard)
+
+  async def _dispatch(self, batch: list[_Queued]) -> None:
+    start = time.perf_counter()
+    for _, _, queued in batch:
+      QUEUE_WAIT_SECONDS.observe(start - queued)
+    BATCH_SIZE.observe(len(batch))
+    IN_FLIGHT.inc(len(batch))
+    try:
+      results = await self.runner([job for job, _, _ in batch])
+    except Exception as e:
+      results = [e] * len(batch)
+    finally:
+      self._slots.release()
+      IN_FLIGHT.dec(len(batch))
+      INFERENCE_SECONDS.observe(time.perf_counter() - start)
+      # Housekeeping waits for a lull, so it never delays the next batch.
+      if self.idle and self.queue.empty() and len(self._batches) <= 1:
+        asyncio.get_running_loop().run_in_executor(None, self.idle)
+
+    for (_, future, _), result in zip(batch, results):
+      if future.done():
+        continue
+      if isinstance(result, Exception):
+        future.set_exception(result)
+      else:
+        future.set_result(result)
+
+
+async def _run_in_process(
+  jobs: list[TranscriptionJob],
+) -> list[TranscriptionResult | Exception]:
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, _transcribe_batch, jobs)
+
+
+async def _iterate_in_thread(
+  func: Callable[..., Iterator[Any]], *args: Any
+) -> AsyncIterator[Any]:
+  "Drive a blocking generator on the default executor."
+  loop = asyncio.get_running_loop()
+  queue: asyncio.Queue[tuple[bool, Any]] = asyncio.Queue(maxsize=16)
+  stopped = threading.Event()
+
+  def put(item: tuple[bool, Any]) -> None:
+    asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+  def produce() -> None:
+    try:
+      for item in func(*args):
+        if stopped.is_set():
+          return
+        put((True, item))
+    except Exception as e:
+      put((False, e))
+    else:
+      put((False, None))
+
+  loop.run_in_executor(None, produce)
+  try:
+    while True:
+      more, item = await queue.get()
+      if not more:
+        if item is not None:
+          raise item
+        return
+      yield item
+  finally:
+    # Free up the producer if it is blocked on a full queue.
+    stopped.set()
+    while not queue.empty():
+      queue.get_nowait()
+
+
+async def _run_in_workers(
+  jobs: list[TranscriptionJob],
+) -> list[TranscriptionResult | Exception]:
+  return await worker_pool.call("_transcribe_batch", jobs)
+
+
+worker_pool: WorkerPool | None = None
+if WORKERS:
+  worker_pool = WorkerPool(
+    WORKERS, cpu_threads=CPU_THREADS or max(1, os.cpu_count() // WORKERS)
+  )
+
+scheduler = BatchScheduler(
+  window=BATCH_WINDOW,
+  max_batch_size=MAX_BATCH_SIZE,
+  runner=_run_in_workers if worker_pool else _run_in_process,
+  concurrency=WORKERS or 1,
+  queue_size=READY_QUEUE_SIZE,
+  idle=governor.check,
+)
+
+Gauge(
+  "whisper_queue_depth",
+  "Transcriptions waiting for the next batch.",
+  function=scheduler.queue.qsize,
+)
+
+
+result_cache = ResultCache(
+  CACHE_MB * 1024**2,
+  encode=TranscriptionResult.to_json,
+  decode=TranscriptionResult.from_json,
+  expire_after=CACHE_EXPIRE_AFTER,
+)
+pcm_cache = LRUCache(PCM_CACHE_MB * 1024**2, sizeof=lambda audio: audio.nbytes)
+pcm_inflight = SingleFlight()
+decode_slots = asyncio.Semaphore(DECODE_CONCURRENCY)
+
+
+class _DecodeStage:
+  """One of decode_slots, held from before a request decodes until its job
+  is in the ready queue (or has a runner, for streams), so a full queue
+  stops new decodes instead of piling up decoded audio waiting to get in.
+  Leaving early, such as for audio with no speech, gives it back too."""
+
+  held: bool
+
+  def __init__(self) -> None:
+    self.held = False
+
+  async def __aenter__(self) -> _DecodeStage:
+    await decode_slots.acquire()
+    self.held = True
+    _decode_stage.set(self)
+    return self
+
+  async def __aexit__(self, *exc_info: Any) -> None:
+    self.release()
+
+  def release(self) -> None:
+    if self.held:
+      self.held = False
+      decode_slots.release()
+
+
+# The stage the current request is in, seen by the scheduler through the
+# tasks a request fans out to. Whichever of them is queued first frees it.
+_decode_stage: contextvars.ContextVar[_DecodeStage | None] = (
+  contextvars.ContextVar("decode_stage", default=None)
+)
+
+
+def _leave_decode_stage() -> None:
+  stage = _decode_stage.get()
+  if stage is not None:
+    stage.release()
+
+
+def _digest(data: bytes) -> str:
+  return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def _cache_key(digest: str, source: str, **options) -> str:
+  """Key a result on the audio and everything that changes the transcription.
+  vad_* options only do that when VAD is on."""
+  if not options.get("use_vad"):
+    options.pop("vad_options", None)
+  options = {
+    "model": MODEL_SIZE,
+    "compute_type": COMPUTE_TYPE,
+    "long": False,
+    "word_timestamps": False,
+    "beam_size": 5,
+    "patience": 1,
+    "speedup": 1.0,
+    **{key: value for key, value in options.items() if value is not None},
+  }
+  return f"{source}:{digest}:{json.dumps(options, sort_keys=True)}"
+
+
+async def _decode_cached(
+  digest: str, decode_audio: Callable[[], Awaitable[numpy.ndarray]]
+) -> numpy.ndarray:
+  audio = pcm_cache.get(digest)
+  if audio is not None:
+    return audio
+
+  async def run() -> numpy.ndarray:
+    audio = await decode_audio()
+    # Cached arrays are shared between requests, so nothing may modify them.
+    audio.flags.writeable = False
+    pcm_cache.set(digest, audio)
+    return audio
+
+  return await pcm_inflight.run(digest, run)
+
+
+def warm_up() -> None:
+  "Run a short synthetic clip so the first request skips first-call setup."
+  rng = numpy.random.default_rng(0)
+  audio = rng.standard_normal(SAMPLE_RATE * 2).astype(numpy.float32) * 0.01
+  _transcribe_batch([TranscriptionJob(audio)])
+
+
+async def _load() -> None:
+  global state, _resident
+  state = "loading"
   loop = asyncio.get_running_loop()
   start = time.time()
+  try:
+    if worker_pool is not None:
+      await worker_pool.start()
+      await worker_pool.broadcast("warm_up")
+    else:
+      await loop.run_in_executor(None, load_model)
+      await loop.run_in_executor(None, warm_up)
+    # VAD runs in this process for long audio and live streams.
+    await loop.run_in_executor(None, get_vad_model)
+    _resident = {(MODEL_SIZE, COMPUTE_TYPE)}
+    state = "ready"
+    LOG.info(f"Model {MODEL_SIZE} ready in {time.time() - start:.2f}s")
+  except Exception:
+    LOG.exception("Failed to load the model!")
+    state = "failed"
+  finally:
+    _ready.set()
+
+
+async def start(*, pool: Pool = None) -> None:
+  """Start loading the model in the background, and attach the cache tiers
+  the service is configured for."""
+  global _loading
+  if _loading is None:
+    loop = asyncio.get_running_loop()
+    _loading = loop.create_task(_load())
+    loop.create_task(governor.watch())
+    # The governor runs on a thread, so the clear is handed to the loop.
+    governor.on_pressure(lambda: loop.call_soon_threadsafe(pcm_cache.clear))
+  if CACHE_POSTGRES and pool is not None and result_cache.pool is None:
+    await result_cache.attach(pool)
+
+
+def _cut_at_pauses(
+  speech: list[dict[str, int]], length: int, limit: int
+) -> list[dict[str, int]]:
+  """Cut [0, length) into windows of at most `limit` samples, each ending in
+  the last pause that fits, or at the limit where there is none."""
+  pauses = [
+    (before["end"] + after["start"]) // 2
+    for before, after in zip(speech, speech[1:])
+  ]
+  windows = []
+  start = 0
+  while length - start > limit:
+    idx = bisect.bisect_right(pauses, start + limit) - 1
+    cut = pauses[idx] if idx >= 0 and pauses[idx] > start else start + limit
+    windows.append({"start": start, "end": cut})
+    start = cut
+  windows.append({"start": start, "end": length})
+  return windows
+
+
+async def _find_windows(audio: numpy.ndarray) -> list[dict[str, int]] | None:
+  """Windows over the whole of `audio` that don't cut words in two, or None
+  when it fits in one. Found before the audio goes near the model."""
+  limit = WINDOW_S * SAMPLE_RATE
+  if audio.shape[0] <= limit:
+    return None
+  speech = await detect_speech(audio, PAUSE_VAD_OPTIONS)
+  return _cut_at_pauses(speech, audio.shape[0], limit)
+
+
+def _split_at_pauses(
+  speech: list[dict[str, int]], length: int, target: int
+) -> list[tuple[int, int]]:
+  "Cut [0, length) into pieces of at least `target` samples between speech."
+  bounds = []
+  start = 0
+  for before, after in zip(speech, speech[1:]):
+    cut = (before["end"] + after["start"]) // 2
+    if cut - start >= target:
+      bounds.append((start, cut))
+      start = cut
+  bounds.append((start, length))
+  return bounds
 
-  def t():
-    return round(time.time() - start, 4)
 
-  print(f"[{t()}] Starting conversion...")
-  file_path = await convert_to_wav(audio_bytes)
-  print(f"[{t()}] Converted to wav, waiting for lock...")
-  async with model_lock:
-    print(f"[{t()}] Lock acquired, transcribing...")
-    result = await loop.run_in_executor(
-      None, _transcribe_file, file_path, use_vad, vad_options
+def _merge_results(
+  parts: list[tuple[float, TranscriptionResult]], duration: float
+) -> TranscriptionResult:
+  "Join results for consecutive pieces of one recording, starting at offsets."
+  segments = []
+  for offset, result in parts:
+    for segment in result.segments:
+      words = segment.words
+      if words:
+        words = [
+          dataclasses.replace(
+            word,
+            start=round(word.start + offset, 3),
+            end=round(word.end + offset, 3),
+          )
+          for word in words
+        ]
+      segments.append(
+        dataclasses.replace(
+          segment,
+          id=len(segments) + 1,
+          seek=segment.seek + round(offset * FRAMES_PER_SECOND),
+          start=round(segment.start + offset, 3),
+          end=round(segment.end + offset, 3),
+          words=words,
+        )
+      )
+
+  # Report the language of the piece with the most speech in it.
+  main = max(
+    (result.info for _, result in parts),
+    key=lambda info: info.duration_after_vad,
+  )
+  info = dataclasses.replace(
+    main,
+    duration=duration,
+    duration_after_vad=sum(
+      result.info.duration_after_vad for _, result in parts
+    ),
+  )
+  return TranscriptionResult(segments, info)
+
+
+async def _find_speech(
+  audio: numpy.ndarray, vad_options: dict[str, float] = None
+) -> tuple[VadOptions, list[dict[str, int]]]:
+  "The speech in `audio`, in regions no longer than the model's window."
+  options = VadOptions(
+    **{**(vad_options or {}), "max_speech_duration_s": WINDOW_S}
+  )
+  return options, await detect_speech(audio, options)
+
+
+def _pack_speech(speech: list[dict[str, int]]) -> list[dict[str, int]]:
+  """Windows over the speech regions joined end to end, each as full as it
+  can be without cutting a region in two."""
+  length = WINDOW_S * SAMPLE_RATE
+  windows = []
+  start = end = 0
+  for region in speech:
+    size = region["end"] - region["start"]
+    if end > start and end - start + size > length:
+      windows.append({"start": start, "end": end})
+      start = end
+    end += size
+  windows.append({"start": start, "end": end})
+  return windows
+
+
+def _speech_job(
+  audio: numpy.ndarray, speech: list[dict[str, int]], **options
+) -> TranscriptionJob:
+  "A job for only the speech in `audio`, so silence never reaches the model."
+  joined = numpy.concatenate(
+    [audio[region["start"] : region["end"]] for region in speech]
+  )
+  return TranscriptionJob(joined, windows=_pack_speech(speech), **options)
+
+
+def _restore_segment(segment: Segment, speech: SpeechTimestampsMap) -> Segment:
+  "Move a segment's times from the joined up speech back to the original."
+  if not segment.words:
+    return dataclasses.replace(
+      segment,
+      start=speech.get_original_time(segment.start),
+      end=speech.get_original_time(segment.end),
     )
-  print(f"[{t()}] Finished transcription.")
-  await aiofiles.os.remove(file_path)
-  print(f"[{t()}] Deleted file..")
-  cleanup()
-  return result
+
+  words = []
+  for word in segment.words:
+    # Both ends of a word come from the same region.
+    region = speech.get_chunk_index((word.start + word.end) / 2)
+    words.append(
+      dataclasses.replace(
+        word,
+        start=speech.get_original_time(word.start, region),
+        end=speech.get_original_time(word.end, region),
+      )
+    )
+  return dataclasses.replace(
+    segment, start=words[0].start, end=words[-1].end, words=words
+  )
+
+
+def _speech_info(
+  info: TranscriptionInfo | None,
+  audio: numpy.ndarray,
+  vad_options: VadOptions,
+) -> TranscriptionInfo:
+  """The info for the whole of `audio` after only its speech was transcribed,
+  or without any (info of None) when it had no speech at all."""
+  if info is None:
+    return TranscriptionInfo(
+      language=None,
+      language_probability=0.0,
+      duration=audio.shape[0] / SAMPLE_RATE,
+      duration_after_vad=0.0,
+      all_language_probs=None,
+      transcription_options=None,
+      vad_options=vad_options,
+    )
+  return dataclasses.replace(
+    info, duration=audio.shape[0] / SAMPLE_RATE, vad_options=vad_options
+  )
 
 
-def _transcribe_bytes(
-  pcm_bytes: bytes, use_vad: bool = False, vad_options: dict[str, float] = None
+async def _transcribe_speech(
+  audio: numpy.ndarray, *, vad_options: dict[str, float] = None, **options
 ) -> TranscriptionResult:
-  audio_array = (
-    numpy.frombuffer(pcm_bytes, numpy.int16).astype(numpy.float32) / 32768.0
+  """Transcribe only the speech in `audio`. Audio without any is answered
+  straight away, without waiting for the model."""
+  vad, speech = await _find_speech(audio, vad_options)
+  if not speech:
+    return TranscriptionResult([], _speech_info(None, audio, vad))
+
+  result = await scheduler.submit(_speech_job(audio, speech, **options))
+  speech_map = SpeechTimestampsMap(speech, SAMPLE_RATE, time_precision=3)
+  segments = [
+    _restore_segment(segment, speech_map) for segment in result.segments
+  ]
+  return TranscriptionResult(segments, _speech_info(result.info, audio, vad))
+
+
+async def transcribe_long(
+  audio: numpy.ndarray, **options
+) -> TranscriptionResult:
+  "Transcribe pieces of a long recording, split at pauses, concurrently."
+  speech = await detect_speech(
+    audio, VadOptions(min_silence_duration_ms=500, speech_pad_ms=200)
+  )
+  bounds = _split_at_pauses(
+    speech, audio.shape[0], int(LONG_CHUNK_S * SAMPLE_RATE)
   )
+  results = await asyncio.gather(
+    *(transcribe_array(audio[start:end], **options) for start, end in bounds)
+  )
+  parts = [
+    (start / SAMPLE_RATE, result) for (start, _), result in zip(bounds, results)
+  ]
+  return _merge_results(parts, audio.shape[0] / SAMPLE_RATE)
+
 
-  segments, info = model.transcribe(
-    audio_array, vad_filter=use_vad, vad_parameters=vad_options
+async def transcribe_array(
+  audio: numpy.ndarray, *, long: bool = False, **options
+) -> TranscriptionResult:
+  """Transcribe already decoded audio, without going through the cache.
+  `options` are the keyword arguments of TranscriptionJob, and use_vad and
+  vad_options to find the speech first."""
+  if long:
+    return await transcribe_long(audio, **options)
+  if options.pop("use_vad", False):
+    return await _transcribe_speech(audio, **options)
+  options.pop("vad_options", None)
+  windows = await _find_windows(audio)
+  return await scheduler.submit(
+    TranscriptionJob(audio, windows=windows, **options)
   )
 
-  segments = list(segments)
-  result = TranscriptionResult(segments, info)
-  return result
 
+async def transcribe_stream(
+  audio: numpy.ndarray, **options
+) -> AsyncIterator[TranscriptionInfo | Segment]:
+  "Yield a TranscriptionInfo followed by each segment as it is decoded."
+  await wait_until_ready()
+  vad_options = options.pop("vad_options", None)
+  speech_map = None
+  if options.pop("use_vad", False):
+    vad, speech = await _find_speech(audio, vad_options)
+    if not speech:
+      yield _speech_info(None, audio, vad)
+      return
+    job = _speech_job(audio, speech, **options)
+    speech_map = SpeechTimestampsMap(speech, SAMPLE_RATE, time_precision=3)
+  else:
+    windows = await _find_windows(audio)
+    job = TranscriptionJob(audio, windows=windows, **options)
 
-async def transcribe_bytes(
-  pcm_bytes: bytes,
+  await ensure_model(job.model, job.compute_type)
+  async with scheduler.slot():
+    if worker_pool is not None:
+      items = worker_pool.stream("_transcribe_stream", job)
+    else:
+      items = _iterate_in_thread(_transcribe_stream, job)
+    async for item in items:
+      if speech_map is None:
+        yield item
+      elif isinstance(item, TranscriptionInfo):
+        yield _speech_info(item, audio, vad)
+      else:
+        yield _restore_segment(item, speech_map)
+
+
+async def detect_language(
+  audio: numpy.ndarray, *, model: str = None, compute_type: str = None
+) -> list[tuple[str, float]]:
+  """Detect the language of already decoded audio, without transcribing it.
+  Only the first 30 seconds are looked at."""
+  model = model or MODEL_SIZE
+  compute_type = compute_type or COMPUTE_TYPE
+  await ensure_model(model, compute_type)
+  async with scheduler.slot():
+    if worker_pool is not None:
+      return await worker_pool.call(
+        "_detect_language", audio, model, compute_type
+      )
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+      None, _detect_language, audio, model, compute_type
+    )
+
+
+async def detect_file(
+  audio_bytes: bytes,
   *,
+  seconds: float = 30,
   use_vad: bool = False,
   vad_options: dict[str, float] = None,
-) -> TranscriptionResult:
+  **options,
+) -> tuple[list[tuple[str, float]], float]:
+  """Detect the language of an uploaded audio file from its first `seconds`,
+  or with VAD, its first `seconds` of speech. Only as much of the file as
+  that takes is decoded. Returns the ranked languages and the seconds used."""
   loop = asyncio.get_running_loop()
-  start = time.time()
-
-  def t():
-    return round(time.time() - start, 4)
+  digest = await loop.run_in_executor(None, _digest, audio_bytes)
+  audio = pcm_cache.get(digest)
+  if audio is None:
+    audio = await decode(
+      audio_bytes, max_seconds=DETECT_SCAN_S if use_vad else seconds
+    )
 
-  print(f"[{t()}] Waiting for lock...")
-  async with model_lock:
-    print(f"[{t()}] Lock acquired, transcribing...")
-    result = await loop.run_in_executor(
-      None, _transcribe_bytes, pcm_bytes, use_vad, vad_options
+  length = int(seconds * SAMPLE_RATE)
+  if use_vad:
+    speech = await detect_speech(audio, VadOptions(**(vad_options or {})))
+    audio = numpy.concatenate(
+      [audio[clip["start"] : clip["end"]] for clip in speech] or [audio[:0]]
     )
-  print(f"[{t()}] Finished transcription.")
-  cleanup()
-  return result
+  audio = audio[:length]
+  languages = await detect_language(audio, **options)
+  return languages, audio.shape[0] / SAMPLE_RATE
+
+
+async def _stream_cached(
+  key: str, audio: Callable[[], Awaitable[numpy.ndarray]], **options
+) -> AsyncIterator[TranscriptionInfo | Segment]:
+  "Stream a transcription, replaying it from the cache when possible."
+  result = result_cache.memory.get(key)
+  if result is not None:
+    yield result.info
+    for segment in result.segments:
+      yield segment
+    return
+
+  start = time.perf_counter()
+  info = None
+  segments = []
+  async with _DecodeStage():
+    audio_array = await audio()
+    async for item in transcribe_stream(audio_array, **options):
+      if isinstance(item, TranscriptionInfo):
+        info = item
+      else:
+        segments.append(item)
+      yield item
+  _observe_speed(audio_array, start)
+  await result_cache.put(key, TranscriptionResult(segments, info))
+
+
+def _observe_speed(audio: numpy.ndarray, start: float) -> None:
+  "Record the real-time factor of a transcription that began at `start`."
+  elapsed = time.perf_counter() - start
+  if elapsed > 0:
+    REAL_TIME_FACTOR.observe(audio.shape[0] / SAMPLE_RATE / elapsed)
+
+
+def _pcm_to_float(pcm_bytes: bytes) -> numpy.ndarray:
+  return (
+    numpy.frombuffer(pcm_bytes, numpy.int16).astype(numpy.float32) / 32768.0
+  )
+
+
+async def stream_file(
+  audio_bytes: bytes, **options
+) -> AsyncIterator[TranscriptionInfo | Segment]:
+  loop = asyncio.get_running_loop()
+  digest = await loop.run_in_executor(None, _digest, audio_bytes)
+  key = _cache_key(digest, "file", **options)
+  async for item in _stream_cached(
+    key, lambda: _decode_cached(digest, lambda: decode(audio_bytes)), **options
+  ):
+    yield item
+
 
+async def stream_upload(
+  upload: Upload, **options
+) -> AsyncIterator[TranscriptionInfo | Segment]:
+  "Like stream_file, for an Upload that has finished arriving."
+  key = _cache_key(upload.digest, "file", **options)
+  needed = False
 
-async def convert_to_wav(data: bytes) -> str:
-  "Convert an audio file to wav by saving it as a temporary file and using ffmpeg to convert it."
-  pool: str = string.ascii_letters + string.digits
-  job_id = "".join(random.choices(pool, k=32))
+  async def audio() -> numpy.ndarray:
+    nonlocal needed
+    needed = True
+    decoded = await _decode_cached(upload.digest, upload.audio)
+    # In case the audio was cached after all.
+    upload.abort()
+    return decoded
 
-  await aiofiles.os.makedirs("/tmp/audioconversion/", exist_ok=True)
+  try:
+    async for item in _stream_cached(key, audio, **options):
+      yield item
+  finally:
+    if not needed:
+      # Answered from the cache, so stop decoding.
+      upload.abort()
 
-  async with aiofiles.open(f"/tmp/audioconversion/{job_id}.src", "wb") as f:
-    await f.write(data)
 
-  proc = await asyncio.create_subprocess_shell(
-    f"ffmpeg -i /tmp/audioconversion/{job_id}.src -vn -acodec pcm_s16le -ar 16000 -ac 1 /tmp/audioconversion/{job_id}.wav"
+def _pcm_source(sample_format: str) -> str:
+  return "raw" if sample_format == "s16le" else f"raw-{sample_format}"
+
+
+async def stream_pcm(
+  audio: numpy.ndarray, digest: str, *, sample_format: str = "s16le", **options
+) -> AsyncIterator[TranscriptionInfo | Segment]:
+  "Stream raw audio already read into an array, as from utils.audio.read_pcm."
+  key = _cache_key(digest, _pcm_source(sample_format), **options)
+
+  async def get_audio() -> numpy.ndarray:
+    return audio
+
+  async for item in _stream_cached(key, get_audio, **options):
+    yield item
+
+
+async def stream_bytes(
+  pcm_bytes: bytes, **options
+) -> AsyncIterator[TranscriptionInfo | Segment]:
+  loop = asyncio.get_running_loop()
+  digest = await loop.run_in_executor(None, _digest, pcm_bytes)
+  async for item in stream_pcm(_pcm_to_float(pcm_bytes), digest, **options):
+    yield item
+
+
+async def transcribe_file(
+  audio_bytes: bytes, *, long: bool = False, **options
+) -> TranscriptionResult:
+  "Transcribe an uploaded audio file. `options` go to TranscriptionJob."
+  loop = asyncio.get_running_loop()
+  digest = await loop.run_in_executor(None, _digest, audio_bytes)
+  key = _cache_key(digest, "file", long=long, **options)
+
+  async def run() -> TranscriptionResult:
+    start = time.perf_counter()
+    async with _DecodeStage():
+      audio_array = await _decode_cached(digest, lambda: decode(audio_bytes))
+      result = await transcribe_array(audio_array, long=long, **options)
+    _observe_speed(audio_array, start)
+    return result
+
+  return await result_cache.get_or_run(key, run)
+
+
+async def transcribe_files(
+  files: list[bytes], *, long: bool = False, **options
+) -> list[TranscriptionResult | Exception]:
+  """Transcribe many audio files with the same options, in the order given.
+  They decode concurrently and share model batches, and each one that fails
+  gets its exception in place of a result."""
+  return await asyncio.gather(
+    *(transcribe_file(data, long=long, **options) for data in files),
+    return_exceptions=True,
   )
 
-  returncode = await proc.wait()
 
-  if returncode != 0:
-    raise Exception("Failed to convert audio file.")
+async def transcribe_upload(
+  upload: Upload, *, long: bool = False, **options
+) -> TranscriptionResult:
+  """Like transcribe_file, for an Upload that has finished arriving and has
+  mostly been decoded while it did."""
+  key = _cache_key(upload.digest, "file", long=long, **options)
+  needed = False
+
+  async def run() -> TranscriptionResult:
+    nonlocal needed
+    needed = True
+    start = time.perf_counter()
+    async with _DecodeStage():
+      audio_array = await _decode_cached(upload.digest, upload.audio)
+      # In case the audio was cached after all.
+      upload.abort()
+      result = await transcribe_array(audio_array, long=long, **options)
+    _observe_speed(audio_array, start)
+    return result
 
-  await aiofiles.os.remove(f"/tmp/audioconversion/{job_id}.src")
+  try:
+    return await result_cache.get_or_run(key, run)
+  finally:
+    if not needed:
+      # Answered from the cache, so stop decoding.
+      upload.abort()
 
-  return f"/tmp/audioconversion/{job_id}.wav"
 
+async def transcribe_bytes(
+  pcm_bytes: bytes, *, long: bool = False, **options
+) -> TranscriptionResult:
+  "Transcribe 16 kHz mono s16le PCM. `options` go to TranscriptionJob."
+  loop = asyncio.get_running_loop()
+  digest = await loop.run_in_executor(None, _digest, pcm_bytes)
+  return await transcribe_pcm(
+    _pcm_to_float(pcm_bytes), digest, long=long, **options
+  )
+
+
+async def transcribe_pcm(
+  audio: numpy.ndarray,
+  digest: str,
+  *,
+  sample_format: str = "s16le",
+  long: bool = False,
+  **options,
+) -> TranscriptionResult:
+  """Transcribe raw audio already read into an array, as from
+  utils.audio.read_pcm. `digest` identifies it in the cache."""
+  key = _cache_key(digest, _pcm_source(sample_format), long=long, **options)
+
+  async def run() -> TranscriptionResult:
+    start = time.perf_counter()
+    result = await transcribe_array(audio, long=long, **options)
+    _observe_speed(audio, start)
+    return result
 
-def cleanup():
-  torch.cuda.empty_cache()
-  torch.cuda.ipc_collect()
-  gc.collect()
+  return await result_cache.get_or_run(key, run)
@@ -0,0 +1,239 @@
+# Inference worker processes, each holding its own WhisperModel
+from __future__ import annotations
+
+import asyncio
+import inspect
+import itertools
+import logging
+import multiprocessing
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from multiprocessing.connection import Connection
+  from multiprocessing.process import BaseProcess
+  from typing import Any, AsyncIterator
+
+LOG = logging.getLogger(__name__)
+
+# Spawned rather than forked, so children never inherit the event loop or
+# CUDA state of the web server.
+ctx = multiprocessing.get_context("spawn")
+
+
+class WorkerCrashedError(Exception):
+  pass
+
+
+def _worker_main(conn: Connection, cpu_threads: int) -> None:
+  "Worker entrypoint: load a model, then run calls sent by the dispatcher."
+  from utils import whisper
+  from utils.memory import governor
+
+  whisper.load_model(cpu_threads=cpu_threads)
+  while True:
+    try:
+      job_id, method, args = conn.recv()
+    except (EOFError, KeyboardInterrupt):
+      return
+
+    try:
+      value = getattr(whisper, method)(*args)
+      if inspect.isgenerator(value):
+        # Generators are streamed back one item at a time.
+        for item in value:
+          conn.send((job_id, "item", item))
+        value = None
+      reply = (job_id, "ok", value)
+    except Exception as e:
+      reply = (job_id, "error", e)
+    try:
+      conn.send(reply)
+    except Exception as e:
+      # Results or exceptions that can't be pickled still resolve the job.
+      conn.send((job_id, "error", RuntimeError(repr(e))))
+    # Only between bursts, never while another call is waiting.
+    if not conn.poll():
+      governor.check()
+
+
+class Worker:
+  index: int
+  process: BaseProcess
+  conn: Connection
+  pending: dict[int, asyncio.Future]
+  streams: dict[int, asyncio.Queue]
+  send_lock: asyncio.Lock
+
+  def __init__(self, index: int, cpu_threads: int) -> None:
+    self.index = index
+    self.cpu_threads = cpu_threads
+    self.pending = {}
+    self.streams = {}
+    self.send_lock = asyncio.Lock()
+    self.conn, child_conn = ctx.Pipe()
+    self.process = ctx.Process(
+      target=_worker_main,
+      args=(child_conn, cpu_threads),
+      name=f"whisper-worker-{index}",
+      daemon=True,
+    )
+    self.process.start()
+    child_conn.close()
+
+  @property
+  def load(self) -> int:
+    return len(self.pending) + len(self.streams)
+
+  def fail_pending(self, exc: Exception) -> None:
+    for future in self.pending.values():
+      if not future.done():
+        future.set_exception(exc)
+    self.pending.clear()
+    for queue in self.streams.values():
+      queue.put_nowait(("error", exc))
+    self.streams.clear()
+
+  def close(self) -> None:
+    try:
+      self.conn.close()
+    except Exception:
+      pass
+    if self.process.is_alive():
+      self.process.terminate()
+    self.process.join(timeout=5)
+
+
+class WorkerPool:
+  """A fixed number of inference processes. Calls go to the worker with the
+  fewest jobs in flight, and workers that die are replaced."""
+
+  size: int
+  cpu_threads: int
+  workers: list[Worker]
+
+  def __init__(self, size: int, *, cpu_threads: int) -> None:
+    self.size = size
+    self.cpu_threads = cpu_threads
+    self.workers = []
+    self._ids = itertools.count()
+    self._monitor: asyncio.Task | None = None
+
+  async def start(self) -> None:
+    for index in range(self.size):
+      self.workers.append(self._spawn(index))
+    self._monitor = asyncio.get_running_loop().create_task(self._watch())
+
+  async def stop(self) -> None:
+    if self._monitor is not None:
+      self._monitor.cancel()
+    loop = asyncio.get_running_loop()
+    for worker in self.workers:
+      loop.remove_reader(worker.conn.fileno())
+      worker.fail_pending(WorkerCrashedError("worker pool stopped"))
+      worker.close()
+    self.workers.clear()
+
+  def _spawn(self, index: int) -> Worker:
+    worker = Worker(index, self.cpu_threads)
+    asyncio.get_running_loop().add_reader(
+      worker.conn.fileno(), self._on_readable, worker
+    )
+    LOG.info(f"Started inference worker {index} (pid {worker.process.pid})")
+    return worker
+
+  def _restart(self, worker: Worker) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+      loop.remove_reader(worker.conn.fileno())
+    except Exception:
+      pass
+    worker.fail_pending(
+      WorkerCrashedError(f"inference worker {worker.index} exited")
+    )
+    worker.close()
+    if worker in self.workers:
+      LOG.warning(f"Inference worker {worker.index} died, restarting it")
+      self.workers[self.workers.index(worker)] = self._spawn(worker.index)
+
+  def _on_readable(self, worker: Worker) -> None:
+    try:
+      while worker.conn.poll():
+        job_id, status, value = worker.conn.recv()
+        if job_id in worker.streams:
+          queue = worker.streams[job_id]
+          if status != "item":
+            del worker.streams[job_id]
+          queue.put_nowait((status, value))
+          continue
+        future = worker.pending.pop(job_id, None)
+        if future is None or future.done():
+          continue
+        if status == "ok":
+          future.set_result(value)
+        else:
+          future.set_exception(value)
+    except (EOFError, OSError):
+      self._restart(worker)
+
+  async def _watch(self) -> None:
+    while True:
+      await asyncio.sleep(1)
+      for worker in list(self.workers):
+        if not worker.process.is_alive():
+          self._restart(worker)
+
+  async def _send(self, worker: Worker, message: tuple) -> None:
+    # Large audio payloads would block the loop while the pipe drains.
+    async with worker.send_lock:
+      await asyncio.get_running_loop().run_in_executor(
+        None, worker.conn.send, message
+      )
+
+  async def call(self, method: str, *args: Any) -> Any:
+    "Run `utils.whisper.<method>(*args)` on the least loaded worker."
+    worker = min(self.workers, key=lambda w: w.load)
+    return await self._call_on(worker, method, *args)
+
+  async def broadcast(self, method: str, *args: Any) -> list[Any]:
+    "Run `utils.whisper.<method>(*args)` once on every worker."
+    return await asyncio.gather(
+      *(self._call_on(worker, method, *args) for worker in self.workers)
+    )
+
+  async def each(self, method: str, *args: Any) -> list[Any]:
+    """Like `broadcast`, but one worker at a time, so only one of them is
+    ever busy with it and the rest carry on serving."""
+    return [
+      await self._call_on(worker, method, *args)
+      for worker in list(self.workers)
+    ]
+
+  async def _call_on(self, worker: Worker, method: str, *args: Any) -> Any:
+    job_id = next(self._ids)
+    future = asyncio.get_running_loop().create_future()
+    worker.pending[job_id] = future
+    try:
+      await self._send(worker, (job_id, method, args))
+    except Exception:
+      worker.pending.pop(job_id, None)
+      raise
+    return await future
+
+  async def stream(self, method: str, *args: Any) -> AsyncIterator[Any]:
+    "Like `call`, for methods that return a generator."
+    worker = min(self.workers, key=lambda w: w.load)
+    job_id = next(self._ids)
+    queue = asyncio.Queue()
+    worker.streams[job_id] = queue
+    try:
+      await self._send(worker, (job_id, method, args))
+      while True:
+        status, value = await queue.get()
+        if status == "item":
+          yield value
+        elif status == "ok":
+          return
+        else:
+          raise value
+    finally:
+      worker.streams.pop(job_id, None)